@@ -9,14 +9,17 @@
 
 # IMPORT LIBRARIES
 #------------------
+import time
+import numpy as np
 import pandas as pd
+from scipy import sparse, linalg
 
 import quantopian.algorithm as algo
 import quantopian.optimize as opt
 
-from quantopian.pipeline import Pipeline
+from quantopian.pipeline import Pipeline, CustomFactor
 from quantopian.pipeline.data import builtin, Fundamentals
-from quantopian.pipeline.factors import AverageDollarVolume, RollingLinearRegressionOfReturns
+from quantopian.pipeline.factors import AverageDollarVolume, Returns
 from quantopian.pipeline.factors.fundamentals import MarketCap
 from quantopian.pipeline.classifiers.fundamentals import Sector
 from quantopian.pipeline.experimental import risk_loading_pipeline
@@ -24,10 +27,479 @@ from quantopian.pipeline.filters import QTradableStocksUS
 from quantopian.pipeline.data import factset
 
 
+# ROLLING BETA
+#--------------
+# SAME BETA AS RollingLinearRegressionOfReturns(target, returns_length, regression_length).beta, BUT
+# INSTEAD OF REFITTING A regression_length POINT REGRESSION PER ASSET EVERY DAY, IT KEEPS RUNNING SUMS 
+# OF x, y, xy AND x^2 (x = TARGET RETURNS, y = ASSET RETURNS) FOR EVERY ASSET AND UPDATES THEM WITH ONE
+# ADD (TODAY'S ROW) AND ONE SUBTRACT (THE ROW THAT LEFT THE WINDOW). THE SUMS ARE RECOMPUTED EXACTLY 
+# FROM THE WINDOW EVERY exact_every DAYS (TO STOP FLOATING POINT DRIFT), WHENEVER THE DAYS ARE NOT 
+# CONSECUTIVE, AND FOR ASSETS THAT JUST ENTERED. LIKE THE REGRESSION, A WINDOW WITH ANY MISSING 
+# RETURN GIVES NaN.
+class RollingBeta(CustomFactor):
+    
+    outputs = ['beta']
+    exact_every = 21
+    
+    def __new__(cls, target, returns_length, regression_length, **kwargs):
+        returns = Returns(window_length=returns_length)
+        return super(RollingBeta, cls).__new__(cls, 
+                                               inputs=[returns, returns[target]], 
+                                               window_length=regression_length, 
+                                               **kwargs)
+    
+    # ROWS OF (MISSING, x, y, xy, x^2) TERMS, SUMMED OVER THE FIRST AXIS
+    @staticmethod
+    def sums(x, y):
+        missing = np.isnan(x) | np.isnan(y)
+        x = np.where(missing, 0.0, x)
+        y = np.where(missing, 0.0, y)
+        return np.array([missing.sum(axis=0), x.sum(axis=0), y.sum(axis=0), 
+                         (x * y).sum(axis=0), (x * x).sum(axis=0)], dtype=float)
+    
+    def compute(self, today, assets, out, returns, target_returns):
+        
+        sids = np.asarray(assets, dtype=np.int64)
+        target = target_returns[:, 0]
+        state = getattr(self, 'state', None)
+        
+        # YESTERDAY'S WINDOW SHIFTED BY EXACTLY ONE ROW: ITS LAST TARGET RETURN IS TODAY'S SECOND TO LAST
+        consecutive = (state is not None and today > state['day'] and 
+                       (target[-2] == state['last_target'] or 
+                        (np.isnan(target[-2]) and np.isnan(state['last_target']))))
+        
+        if consecutive and state['age'] < self.exact_every:
+            idx = np.searchsorted(state['sids'], sids).clip(0, len(state['sids']) - 1)
+            known = state['sids'][idx] == sids
+            
+            new = np.flatnonzero(~known)
+            sums = state['sums'][:, idx]
+            sums += self.sums(target[-1:, None], returns[-1:]) - self.sums(state['first_target'], state['first'][None, idx])
+            sums[:, new] = self.sums(target[:, None], returns[:, new])
+            age = state['age'] + 1
+        else:
+            sums = self.sums(target[:, None], returns)
+            age = 0
+        
+        missing, sx, sy, sxy, sxx = sums
+        n = len(target)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        out.beta[:] = np.where(missing > 0.5, np.nan, beta)
+        
+        self.state = {'sids': sids, 'sums': sums, 'age': age, 'day': today, 
+                      'first': returns[0].copy(), 'first_target': target[:1, None].copy(), 
+                      'last_target': target[-1]}
+
+
+# FUSED FUNDAMENTAL ALPHA
+#-------------------------
+# ONE PASS PER TERM INSTEAD OF FOUR: FOR EVERY INPUT COLUMN THE WINSORIZE CUT-POINTS ARE FOUND WITH 
+# LINEAR-TIME SELECTION (np.partition, SAME ORDER STATISTICS AS .winsorize), THEN THE COLUMN IS 
+# CLIPPED, STANDARDIZED (.zscore) AND ADDED WITH ITS WEIGHT INTO THE PREALLOCATED OUTPUT. THE SUM IS 
+# THEN RANKED AND DEMEANED IN PLACE. EQUIVALENT TO
+#     (w1 * col1.latest.winsorize(lo, hi).zscore() + w2 * col2.latest.winsorize(lo, hi).zscore() + ...).rank().demean()
+# e.g. WinsorizedZScoreAlpha(inputs=[Fundamentals.assets_turnover, Fundamentals.change_in_working_capital], weights=(1, 2))
+class WinsorizedZScoreAlpha(CustomFactor):
+    
+    window_length = 1
+    params = {'weights': None, 'min_percentile': 0.05, 'max_percentile': 0.95}
+    
+    def compute(self, today, assets, out, *columns, **params):
+        
+        weights = params['weights'] or (1,) * len(columns)
+        out[:] = 0.0
+        
+        for column, weight in zip(columns, weights):
+            values = column[-1]
+            valid = ~np.isnan(values)
+            x = values[valid]
+            n = len(x)
+            if n == 0:
+                out[:] = np.nan
+                return
+            
+            # WINSORIZE CUT-POINTS (THE SAME ORDER STATISTICS AS .winsorize(min_percentile, max_percentile))
+            lower = int(params['min_percentile'] * n)
+            upper = min(int(np.ceil(params['max_percentile'] * n)) - 1, n - 1)
+            cuts = np.partition(x, [lower, upper])
+            np.clip(x, cuts[lower], cuts[upper], out=x)
+            
+            # ZSCORE (POPULATION STD, LIKE .zscore) AND WEIGHTED ACCUMULATION
+            mean = x.sum() / n
+            x -= mean
+            std = np.sqrt(np.dot(x, x) / n)
+            out[valid] += x * (weight / std)
+            out[~valid] = np.nan
+        
+        # RANK (ORDINAL, TIES BY SID) AND DEMEAN: RANKS 1..m HAVE MEAN (m + 1) / 2
+        valid = ~np.isnan(out)
+        m = valid.sum()
+        order = np.flatnonzero(valid)[out[valid].argsort(kind='mergesort')]
+        out[order] = np.arange(1, m + 1) - (m + 1) / 2.0
+
+
+# PIPELINE PRECOMPUTATION (OFFLINE BACKTESTS)
+#---------------------------------------------
+# IN AN OFFLINE ZIPLINE BACKTEST, precompute_pipeline SPLITS THE SESSIONS INTO CHUNKS, RUNS EVERY 
+# CHUNK ON A PROCESS POOL AND STITCHES THE RESULTS. STORED IN PRECOMPUTED_PIPELINES (BY PIPELINE NAME) 
+# BEFORE THE BACKTEST STARTS, THAT PIPELINE IS NOT ATTACHED AND ITS DAILY OUTPUT BECOMES A LOOKUP. 
+# EACH CHUNK STARTS PIPELINE_LOOKBACK SESSIONS EARLY SO THAT FACTORS THAT KEEP STATE ACROSS DAYS 
+# (RUNNING SUMS, INCREMENTAL RANKS) ARE WARM; THOSE OVERLAP ROWS ARE DROPPED WHEN STITCHING.
+# run_chunk(start, end) MUST RETURN THE run_pipeline FRAME FOR make_pipeline() OVER [start, end], 
+# e.g. lambda start, end: engine.run_pipeline(make_pipeline(), start, end). WORKERS ARE FORKED, SO IT 
+# DOES NOT NEED TO BE PICKLABLE, BUT THIS FILE MUST BE IMPORTED AS A MODULE (e.g. imp.load_source).
+# THE QUANTOPIAN IDE HAS NO PROCESS POOLS, SO THERE PRECOMPUTED_PIPELINES STAYS EMPTY.
+# THE OUTPUT IS ONLY READ ON THE DAYS THE SCHEDULED FUNCTIONS RUN, SO WITH days (e.g. 
+# scheduled_sessions(sessions, 'month_start')) ONLY THOSE SESSIONS ARE EVALUATED, EACH WARMED UP overlap
+# SESSIONS EARLY; WARM-UPS THAT OVERLAP ARE MERGED INTO ONE JOB (UP TO chunk_size SESSIONS).
+# RollingBeta RECOMPUTES EXACTLY ON NON-CONSECUTIVE DAYS, SO WITH days overlap DEFAULTS TO 0 AND EVERY 
+# week_start SESSION IS ITS OWN ONE-DAY JOB (256-SESSION WARM-UPS WOULD COVER MORE THAN A FULL RUN)
+# (THE BETA REGRESSION IS THE LONGEST WINDOW: 252 DAYS OF 5 DAY RETURNS = 256 SESSIONS)
+PIPELINE_LOOKBACK = 256
+PRECOMPUTED_PIPELINES = {}
+_CHUNK_RUNNER = None
+
+def precompute_pipeline(run_chunk, sessions, chunk_size=252, overlap=None, processes=None, days=None):
+    
+    import multiprocessing
+    global _CHUNK_RUNNER
+    _CHUNK_RUNNER = run_chunk
+    
+    sessions = pd.DatetimeIndex(sessions)
+    if overlap is None:
+        overlap = PIPELINE_LOOKBACK if days is None else 0
+    if days is None:
+        starts = range(0, len(sessions), chunk_size)
+        jobs = [(max(start - overlap, 0), start, min(start + chunk_size, len(sessions)) - 1) for start in starts]
+    else:
+        days = pd.DatetimeIndex(days)
+        jobs = []
+        for day in sessions.searchsorted(days):
+            if jobs and day - overlap <= jobs[-1][2] + 1 and day - jobs[-1][1] < chunk_size:
+                jobs[-1][2] = day
+            else:
+                jobs.append([max(day - overlap, 0), day, day])
+    jobs = [(sessions[warm_start], sessions[start], sessions[end]) for warm_start, start, end in jobs]
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        frames = pool.map(_run_chunk, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    frame = pd.concat(frames)
+    if days is not None:
+        frame = frame[frame.index.get_level_values(0).isin(days)]
+    return frame
+
+# SESSIONS ON WHICH A date_rules.month_start() OR date_rules.week_start() FUNCTION RUNS 
+# (THE FIRST SESSION OF EVERY MONTH OR WEEK)
+def scheduled_sessions(sessions, rule):
+    sessions = pd.DatetimeIndex(sessions)
+    if rule == 'month_start':
+        period = np.asarray(sessions.year * 12 + sessions.month)
+    else:
+        period = np.asarray((sessions - pd.to_timedelta(sessions.dayofweek, unit='D')).normalize())
+    return sessions[np.concatenate([[True], period[1:] != period[:-1]])]
+
+def _run_chunk(job):
+    warm_start, start, end = job
+    frame = _CHUNK_RUNNER(warm_start, end)
+    return frame[frame.index.get_level_values(0) >= start]
+
+# ATTACH A PIPELINE UNLESS ITS OUTPUT WAS PRECOMPUTED
+def attach(pipe, name):
+    if name not in PRECOMPUTED_PIPELINES:
+        algo.attach_pipeline(pipe, name)
+
+# TODAY'S OUTPUT OF A PIPELINE (A LOOKUP WHEN IT WAS PRECOMPUTED)
+def load_pipeline_output(name):
+    if name not in PRECOMPUTED_PIPELINES:
+        return algo.pipeline_output(name)
+    return PRECOMPUTED_PIPELINES[name].xs(algo.get_datetime().normalize(), level=0)
+
+
+# LOCAL WARM-STARTED SOLVER
+#--------------------------
+# MaximizeAlpha WITH MaxGrossExposure, PositionConcentration AND LINEAR EXPOSURE BOUNDS (DollarNeutral, 
+# BETA, SECTOR/STYLE RISK) IS A LINEAR PROGRAM:
+#
+#     MAXIMIZE alpha.w  SUBJECT TO  lower <= w <= upper,  sum|w| <= gross,  lo <= A.w <= hi
+#
+# WRITING w = p - q (p, q >= 0) GIVES ONE COUPLING ROW PER CONSTRAINT AND THOUSANDS OF BOUNDED 
+# VARIABLES, WHICH A BOUNDED-VARIABLE PRIMAL SIMPLEX HANDLES WITH A TINY (ROWS x ROWS) BASIS. THE 
+# PROBLEM ONLY CHANGES A LITTLE FROM DAY TO DAY, SO EACH SOLVE STARTS FROM YESTERDAY'S BASIS AND 
+# THE ASSETS THAT SAT AT A POSITION BOUND (THE ACTIVE SET), WHICH USUALLY NEEDS A HANDFUL OF PIVOTS.
+# BASIC VARIABLES OF ASSETS THAT LEFT THE UNIVERSE ARE REPLACED BY SLACKS, SO CHURN KEEPS THE REST OF 
+# THE BASIS.
+# IF TODAY'S DATA MAKE THAT START INFEASIBLE A SHORT PHASE 1 FROM THE SAME BASIS MOVES THE BASIC 
+# VARIABLES BACK WITHIN THEIR BOUNDS; ONLY IF THAT FAILS IT STARTS FROM w = 0, WHICH IS ALWAYS FEASIBLE.
+# WHILE PIVOTS ARE DEGENERATE (ZERO STEP) IT SWITCHES TO BLAND'S RULE SO IT CANNOT CYCLE. IF IT STILL
+# HAS NOT REACHED THE OPTIMUM AFTER max_iterations, converged IS False, solve RETURNS None AND THE 
+# NEXT SOLVE STARTS COLD; THE CALLER THEN FALLS BACK TO order_optimal_portfolio.
+# solve_time (SECONDS), iterations, converged AND warm ARE KEPT FROM THE LAST SOLVE.
+class WarmStartLP(object):
+    
+    def __init__(self, max_iterations=5000, tolerance=1e-9):
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.state = None
+        self.iterations = 0
+        self.solve_time = 0.0
+        self.converged = True
+        self.warm = False
+    
+    # sids MUST BE SORTED (PIPELINE OUTPUT ORDER); A IS (ROWS x ASSETS), DENSE OR SPARSE
+    def solve(self, sids, alpha, lower, upper, gross, A, lo, hi):
+        
+        start_time = time.time()
+        sids = np.asarray(sids, dtype=np.int64)
+        alpha = np.asarray(alpha, dtype=float)
+        A = sparse.csc_matrix(A, dtype=float) if sparse.issparse(A) else np.asarray(A, dtype=float)
+        n = len(sids)
+        m = A.shape[0] + 1
+        nv = 2 * n + m
+        
+        # VARIABLES: LONG PARTS p, SHORT PARTS q AND ONE SLACK PER ROW (s = G.[p; q], ROW 0 IS GROSS)
+        lb = np.concatenate([np.zeros(2 * n), [-np.inf], lo])
+        ub = np.concatenate([np.maximum(upper, 0), np.maximum(-lower, 0), [gross], hi])
+        c = np.concatenate([-alpha, alpha, np.zeros(m)]) / max(np.abs(alpha).max(), 1e-12)
+        
+        # COLUMNS OF M = [G, -I] FOR THE VARIABLE INDICES j
+        def columns(j):
+            j = np.asarray(j)
+            cols = np.zeros((m, len(j)))
+            x = j < 2 * n
+            cols[0, x] = 1.0
+            block = A[:, j[x] % n]
+            cols[1:, x] = (block.toarray() if sparse.issparse(block) else block) * np.where(j[x] < n, 1.0, -1.0)
+            cols[j[~x] - 2 * n, np.flatnonzero(~x)] = -1.0
+            return cols
+        
+        # M.z
+        def product(z):
+            return np.concatenate([[z[:2 * n].sum()], A.dot(z[:n] - z[n:2 * n])]) - z[2 * n:]
+        
+        # BOUNDED PRIMAL SIMPLEX FROM (basis, at_upper), UPDATED IN PLACE, MINIMIZING cost.z WITHIN 
+        # [lower, upper]; RETURNS z, THE NUMBER OF ITERATIONS AND WHETHER IT REACHED THE OPTIMUM
+        def simplex(basis, at_upper, cost, lower, upper):
+            
+            basic = np.zeros(nv, dtype=bool)
+            degenerate = False
+            iteration = -1
+            for iteration in range(self.max_iterations):
+                
+                # BASIC VALUES FOR THE CURRENT BASIS (NON-BASIC VARIABLES SIT AT A BOUND)
+                basic[:] = False
+                basic[basis] = True
+                z = np.where(at_upper, upper, lower)
+                z[basis] = 0.0
+                B = columns(basis)
+                zb = np.linalg.solve(B, -product(z))
+                z[basis] = zb
+                
+                # REDUCED COSTS; STOP WHEN NO NON-BASIC VARIABLE CAN IMPROVE THE OBJECTIVE
+                pi = np.linalg.solve(B.T, cost[basis])
+                exposure = A.T.dot(pi[1:])
+                d = cost - np.concatenate([pi[0] + exposure, pi[0] - exposure, -pi])
+                movable = ~basic & (upper > lower)
+                gain = np.where(movable & ~at_upper & (d < -self.tolerance), -d, 0.0)
+                gain = np.where(movable & at_upper & (d > self.tolerance), d, gain)
+                improving = np.flatnonzero(gain > 0)
+                if len(improving) == 0:
+                    return z, iteration + 1, True
+                
+                # ENTERING VARIABLE: THE LARGEST GAIN, OR THE LOWEST INDEX AFTER A DEGENERATE PIVOT (BLAND)
+                j = improving[0] if degenerate else improving[gain[improving].argmax()]
+                
+                # RATIO TEST: THE ENTERING VARIABLE EITHER FLIPS TO ITS OTHER BOUND OR REPLACES A BASIC ONE
+                direction = -1.0 if at_upper[j] else 1.0
+                delta = -np.linalg.solve(B, columns([j])[:, 0]) * direction
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    steps = np.where(delta < -self.tolerance, (zb - lower[basis]) / -delta, 
+                                     np.where(delta > self.tolerance, (upper[basis] - zb) / delta, np.inf))
+                r = steps.argmin()
+                
+                # ON A ZERO STEP THE LEAVING VARIABLE IS THE LOWEST INDEX AMONG THE TIES (BLAND)
+                degenerate = steps[r] <= self.tolerance
+                if degenerate:
+                    ties = np.flatnonzero(steps <= self.tolerance)
+                    r = ties[basis[ties].argmin()]
+                if upper[j] - lower[j] <= steps[r]:
+                    at_upper[j] = not at_upper[j]
+                else:
+                    at_upper[basis[r]] = delta[r] > 0
+                    at_upper[j] = False
+                    basis[r] = j
+            return z, iteration + 1, False
+        
+        # COLD START: EVERY SLACK IS BASIC AND w = 0 (THE GROSS SLACK HAS NO LOWER BOUND)
+        at_upper = np.zeros(nv, dtype=bool)
+        at_upper[2 * n] = True
+        basis = np.arange(2 * n, nv)
+        phase_one = 0
+        
+        self.warm = False
+        if self.state is not None:
+            old_sids, old_upper, old_basis = self.state
+            old_n = len(old_sids)
+            pos = np.searchsorted(old_sids, sids).clip(0, max(old_n - 1, 0))
+            known = old_sids[pos] == sids if old_n else np.zeros(n, dtype=bool)
+            
+            # MAP YESTERDAY'S VARIABLE INDICES TO TODAY'S (-1 FOR ASSETS THAT LEFT)
+            remap = np.full(2 * old_n + m, -1, dtype=int)
+            remap[pos[known]] = np.flatnonzero(known)
+            remap[old_n + pos[known]] = n + np.flatnonzero(known)
+            remap[2 * old_n:] = np.arange(2 * n, nv)
+            
+            guess_upper = np.zeros(nv, dtype=bool)
+            moved = remap[np.flatnonzero(old_upper)]
+            guess_upper[moved[moved >= 0]] = True
+            guess_upper[2 * n] = True
+            guess_basis = remap[old_basis]
+            
+            # THE ROWS ON WHICH THE REMAINING BASIC COLUMNS ARE INDEPENDENT (PIVOTED QR) KEEP THEM, THE 
+            # OTHER ROWS GET THEIR SLACKS IN PLACE OF THE BASIC VARIABLES OF ASSETS THAT LEFT
+            departed = guess_basis < 0
+            if departed.any():
+                kept = guess_basis[~departed]
+                rows = linalg.qr(columns(kept).T, mode='r', pivoting=True)[1] if len(kept) else np.arange(m)
+                guess_basis[departed] = 2 * n + rows[len(kept):]
+            
+            if len(np.unique(guess_basis)) == m:
+                guess_upper[guess_basis] = False
+                z = np.where(guess_upper, ub, lb)
+                z[guess_basis] = 0.0
+                try:
+                    zb = np.linalg.solve(columns(guess_basis), -product(z))
+                except np.linalg.LinAlgError:
+                    zb = None
+                
+                # PHASE 1: TODAY'S DATA MAY PUT BASIC VARIABLES OUTSIDE THEIR BOUNDS. EACH ONE GETS A 
+                # TEMPORARY RANGE FROM ITS VALUE TO THE BOUND IT BROKE AND A UNIT COST TOWARDS THAT BOUND; 
+                # IF THEY ALL REACH IT THE BASIS IS FEASIBLE AGAIN, OTHERWISE THE SOLVE STARTS COLD
+                if zb is not None:
+                    low = guess_basis[zb < lb[guess_basis] - 1e-9]
+                    high = guess_basis[zb > ub[guess_basis] + 1e-9]
+                    reached = True
+                    if len(low) or len(high):
+                        cost, lower, upper = np.zeros(nv), lb.copy(), ub.copy()
+                        value = np.zeros(nv)
+                        value[guess_basis] = zb
+                        cost[low], lower[low], upper[low] = -1.0, value[low], lb[low]
+                        cost[high], lower[high], upper[high] = 1.0, ub[high], value[high]
+                        z, phase_one, reached = simplex(guess_basis, guess_upper, cost, lower, upper)
+                        reached = reached and (z[low] >= lb[low] - 1e-9).all() and (z[high] <= ub[high] + 1e-9).all()
+                        guess_upper[low] = False
+                        guess_upper[high] = True
+                        guess_upper[guess_basis] = False
+                    if reached:
+                        basis, at_upper = guess_basis, guess_upper
+                        self.warm = True
+        
+        z, iterations, self.converged = simplex(basis, at_upper, c, lb, ub)
+        self.iterations = phase_one + iterations
+        self.solve_time = time.time() - start_time
+        if not self.converged:
+            self.state = None
+            return None
+        nonbasic = np.ones(nv, dtype=bool)
+        nonbasic[basis] = False
+        self.state = (sids, at_upper & nonbasic, basis.copy())
+        return z[:n] - z[n:2 * n]
+
+
+# RISK MODEL STYLE FACTORS (EVERY OTHER risk_loading_pipeline COLUMN IS A SECTOR)
+RISK_STYLES = ['momentum', 'size', 'value', 'short_term_reversal', 'volatility']
+
+# RISK LOADING CACHE
+#--------------------
+# KEEPS THE risk_loading_pipeline OUTPUT ACROSS DAYS IN A COMPACT FORM: SECTOR MEMBERSHIP (ONE-HOT IN 
+# THE PIPELINE) AS ONE int8 CODE PER ASSET (-1 = NO SECTOR) AND THE STYLE LOADINGS AS float32. update 
+# CARRIES YESTERDAY'S ROWS OVER BY SID AND ONLY WRITES THE ROWS THAT CHANGED (changed COUNTS THEM). 
+# exposures RETURNS THE (SECTORS + STYLES) x ASSETS LOADINGS AS A SPARSE MATRIX FOR THE SOLVER; 
+# ASSETS WITHOUT LOADINGS GET 0, LIKE reindex(...).fillna(0).
+class RiskLoadingCache(object):
+    
+    def __init__(self, styles=RISK_STYLES):
+        self.styles = list(styles)
+        self.sectors = None
+        self.sids = np.zeros(0, dtype=np.int64)
+        self.sector = np.zeros(0, dtype=np.int8)
+        self.style = np.zeros((0, len(self.styles)), dtype=np.float32)
+        self.changed = 0
+    
+    def update(self, loadings):
+        
+        if self.sectors is None:
+            self.sectors = [column for column in loadings.columns if column not in self.styles]
+        sids = np.array([asset.sid for asset in loadings.index], dtype=np.int64)
+        one_hot = np.nan_to_num(loadings[self.sectors].values)
+        sector = np.where(one_hot.max(axis=1) > 0, one_hot.argmax(axis=1), -1).astype(np.int8)
+        style = np.nan_to_num(loadings[self.styles].values).astype(np.float32)
+        
+        # CARRY OVER THE ROWS OF ASSETS ALREADY CACHED, THEN APPLY TODAY'S CHANGED ROWS ONLY
+        if not np.array_equal(sids, self.sids):
+            pos, known = self._locate(sids)
+            sector_rows = np.full(len(sids), -2, dtype=np.int8)
+            style_rows = np.full((len(sids), len(self.styles)), np.nan, dtype=np.float32)
+            sector_rows[known] = self.sector[pos[known]]
+            style_rows[known] = self.style[pos[known]]
+            self.sids, self.sector, self.style = sids, sector_rows, style_rows
+        
+        changed = np.flatnonzero((sector != self.sector) | (style != self.style).any(axis=1))
+        self.sector[changed] = sector[changed]
+        self.style[changed] = style[changed]
+        self.changed = len(changed)
+    
+    # POSITIONS OF sids IN THE CACHE AND WHETHER THEY ARE CACHED
+    def _locate(self, sids):
+        if not len(self.sids):
+            return np.zeros(len(sids), dtype=int), np.zeros(len(sids), dtype=bool)
+        pos = np.searchsorted(self.sids, sids).clip(0, len(self.sids) - 1)
+        return pos, self.sids[pos] == sids
+    
+    # sids MUST BE SORTED (PIPELINE OUTPUT ORDER)
+    def exposures(self, sids):
+        
+        sids = np.asarray(sids, dtype=np.int64)
+        pos, known = self._locate(sids)
+        sector = np.full(len(sids), -1, dtype=int)
+        style = np.zeros((len(sids), len(self.styles)), dtype=np.float32)
+        sector[known] = self.sector[pos[known]]
+        style[known] = self.style[pos[known]]
+        
+        members = np.flatnonzero(sector >= 0)
+        sector_rows = sparse.csr_matrix((np.ones(len(members), dtype=np.float32), (sector[members], members)), 
+                                        shape=(len(self.sectors or []), len(sids)))
+        return sparse.vstack([sector_rows, sparse.csr_matrix(style.T)])
+
+
+# TARGET WEIGHTS FOR THE CONTEST CONSTRAINT SET, SOLVED WITH THE WARM-STARTED SOLVER, None IF IT DID NOT CONVERGE
+# (risk_loadings IS A RiskLoadingCache; DEFAULT RISK BOUNDS MATCH RiskModelExposure: SECTOR +-0.18, STYLE +-0.36)
+def solve_max_alpha(solver, alpha, beta, risk_loadings, leverage, max_short, max_long, 
+                    dollar_tolerance, beta_bound, sector_bound=0.18, style_bound=0.36):
+    
+    assets = alpha.index
+    sids = [asset.sid for asset in assets]
+    
+    A = sparse.vstack([np.vstack([np.ones(len(assets)), beta.reindex(assets).fillna(0).values]), 
+                       risk_loadings.exposures(sids)])
+    bounds = np.concatenate([[dollar_tolerance, beta_bound], 
+                             np.full(len(risk_loadings.sectors), sector_bound), 
+                             np.full(len(risk_loadings.styles), style_bound)])
+    
+    weights = solver.solve(sids, alpha.values, 
+                           np.full(len(assets), max_short), np.full(len(assets), max_long), 
+                           leverage, A, -bounds, bounds)
+    return None if weights is None else pd.Series(weights, index=assets)
+
+
 # ALGORITHM PARAMETERS
 #----------------------
 
-def initialize(context):
+def make_pipeline():
     
     # DEFINE UNIVERSE
     # ------------------
@@ -39,18 +511,17 @@ def initialize(context):
     # COMPUTE Z SCORES: ASSET TURNOVER AND CHANGE IN WORKING CAPITAL
     # BOTH ARE FUNDAMENTAL VALUE MEASURES
     
-    asset_turnover = Fundamentals.assets_turnover.latest.winsorize(.05, .95).zscore()
-    ciwc = Fundamentals.change_in_working_capital.latest.winsorize(.05, .95).zscore()
-     
-        
     # ALPHA COMBINATION
     # -----------------
     # ASSIGN EVERY ASSET AN ALPHA RANK AND CENTER VALUES AT 0 (DEMEAN).
-    alpha = (asset_turnover + 2*ciwc).rank().demean()
+    # SAME AS (asset_turnover + 2*ciwc).rank().demean() ON THE WINSORIZED Z SCORES, IN ONE FACTOR.
+    alpha = WinsorizedZScoreAlpha(inputs=[Fundamentals.assets_turnover, 
+                                          Fundamentals.change_in_working_capital],
+                                  weights=(1, 2))
     
     
     # BETA DEFINITION
-    beta = 0.66*RollingLinearRegressionOfReturns(
+    beta = 0.66*RollingBeta(
                     target=sid(8554),
                     returns_length=5,
                     regression_length=252,
@@ -70,10 +541,14 @@ def initialize(context):
         # RETURN ONLY "NOT NULL" VALUES IN OUR PIPELINE
         screen=alpha.notnull() & Sector().notnull() & beta.notnull() & universe,
     )
+    return pipe
+
+
+def initialize(context):
     
     # LOAD ALL PIPELINES
-    algo.attach_pipeline(pipe, 'pipe')
-    algo.attach_pipeline(risk_loading_pipeline(), 'risk_loading_pipeline')
+    attach(make_pipeline(), 'pipe')
+    attach(risk_loading_pipeline(), 'risk_loading_pipeline')
     
     
     # SCHEDULE FUNCTIONS
@@ -84,18 +559,31 @@ def initialize(context):
         time_rule=algo.time_rules.market_open(minutes=10),
         half_days=False,
     )
+    
+    
+    # OPTIMIZER (False USES THE BUILT-IN SOLVER OF order_optimal_portfolio)
+    #-----------
+    context.use_local_solver = True
+    context.solver = WarmStartLP()
+    context.risk_loadings = RiskLoadingCache()
 
 
-# BEFORE TRADING START
-#----------------------        
-def before_trading_start(context, data):
-    context.pipeline_data = algo.pipeline_output('pipe')
-    context.risk_loading_pipeline = algo.pipeline_output('risk_loading_pipeline')
+# LOAD PIPELINES (ONLY ON week_start, THE ONLY DAYS THE OUTPUT IS READ)
+#-----------------------------------------------------------------------        
+def load_pipelines(context):
+    context.pipeline_data = load_pipeline_output('pipe')
+    
+    # THE LOCAL SOLVER READS THE COMPACT CACHE; THE FRAME IS KEPT FOR RiskModelExposure (THE BUILT-IN 
+    # SOLVER, AND THE FALLBACK WHEN THE LOCAL SOLVER DOES NOT CONVERGE)
+    context.risk_loading_pipeline = load_pipeline_output('risk_loading_pipeline')
+    if context.use_local_solver:
+        context.risk_loadings.update(context.risk_loading_pipeline)
 
 
 # PORTFOLIO CONSTRUCTION
 #------------------------
 def do_portfolio_construction(context, data):
+    load_pipelines(context)
     pipeline_data = context.pipeline_data
 
     # OBJECTIVE
@@ -137,15 +625,26 @@ def do_portfolio_construction(context, data):
                                       min_exposures={'beta': -0.05}, 
                                       max_exposures={'beta': 0.05})
         
+    # EXECUTE OPTIMIZATION
+    # =========================================================================================
+    # LOCAL SOLVER: SAME OBJECTIVE AND CONSTRAINTS, WARM-STARTED FROM LAST WEEK'S SOLUTION
+    # (IF IT DOES NOT CONVERGE, THE BUILT-IN SOLVER BELOW IS USED INSTEAD)
+    if context.use_local_solver:
+        weights = solve_max_alpha(context.solver, pipeline_data.alpha, pipeline_data.beta, context.risk_loadings, 
+                                  MAX_GROSS_LEVERAGE, -MAX_SHORT_POSITION_SIZE, MAX_LONG_POSITION_SIZE, 
+                                  dollar_tolerance=0.0001, beta_bound=0.05)
+        algo.record(solve_ms = 1000 * context.solver.solve_time, solver_iterations = context.solver.iterations)
+        if weights is not None:
+            algo.order_optimal_portfolio(objective=opt.TargetWeights(weights), constraints=[])
+            return
+        log.info('Local solver did not converge in %d iterations, using order_optimal_portfolio' % context.solver.iterations)
+    
     # CONSTRAIN COMMON SECTOR AND STYLE RISK FACTORS (NEWEST DEFAULT VALUES)
     # SECTOR DEFAULT: +-0.18
     # STYLE DEFAULT: +-0.36
     constrain_sector_style_risk = opt.experimental.RiskModelExposure(context.risk_loading_pipeline, 
                                                                      version=opt.Newest)
-                                                                     
-        
-    # EXECUTE OPTIMIZATION
-    # =========================================================================================
+    
     # CALCULATE NEW WEIGHTS AND MANAGE MOVING PORTFOLIO TOWARD TARGET CAPITAL AND ASSET ALLOCATION
     algo.order_optimal_portfolio(objective=objective, 
                                  constraints=[max_leverage, 
@@ -48,8 +48,334 @@ based on a rebuilt order book and volume metrics for accurate transaction cost e
 """
 
 import math
+from collections import deque
 import numpy as np
-from talib import ATR
+import pandas as pd
+
+
+# ROLL-ADJUSTED CONTINUOUS FUTURES STORE (OFFLINE BACKTESTS)
+#-----------------------------------------------------------
+# data.history on a continuous future stitches the contracts and applies the back-adjustment on 
+# every call, and data.current(..., 'contract') resolves the active contract again every bar. 
+# ContinuousFutureStore.build does the stitching once per root and roll rule, offline. It writes 
+# .npy arrays holding the sessions, the active contract of every session, the adjusted OHLC, 
+# price and volume series and the cumulative adjustment. Loaded with mmap_mode='r', a backtest 
+# (or every process of a parameter sweep) reads a window as a slice plus one rescale, and the 
+# contract as one lookup. The Quantopian IDE has no file access, so there 
+# CONTINUOUS_FUTURES_STORE_PATH stays None and future_history / future_contracts fall back to 
+# data.history / data.current.
+CONTINUOUS_FUTURES_STORE_PATH = None
+CONTINUOUS_FUTURES_FIELDS = ['open', 'high', 'low', 'close', 'price', 'volume']
+
+class ContinuousFutureStore(object):
+    
+    def __init__(self, path):
+        self.path = path
+        self.series = {}
+    
+    @staticmethod
+    def key(root_symbol, roll, adjustment, offset=0):
+        return '%s_%s_%s_%d' % (root_symbol, roll, adjustment, offset)
+    
+    # Arrays of one continuous future, loaded (memory-mapped) on first use
+    def _series(self, future):
+        key = self.key(future.root_symbol, future.roll_style, future.adjustment, future.offset)
+        if key not in self.series:
+            self.series[key] = dict((name, np.load('%s/%s.%s.npy' % (self.path, key, name), mmap_mode='r')) 
+                                    for name in ['sessions', 'contract', 'scale'] + CONTINUOUS_FUTURES_FIELDS)
+        return self.series[key]
+    
+    # bars: {FIELD: DataFrame of raw daily bars, one row per session and one column per contract sid,
+    #        columns in expiration order}
+    # auto_close_dates: auto close date of each contract (same order as the columns)
+    # roll: 'calendar' rolls on the front contract's auto close date, 'volume' rolls as soon as the 
+    #       next contract traded more than the front one the session before (and at the auto close 
+    #       date at the latest)
+    # adjustment: 'mul' (prices before a roll are multiplied by next/front close the session before 
+    #             the roll), 'add' (shifted by next - front) or None
+    @staticmethod
+    def build(path, root_symbol, bars, auto_close_dates, roll='calendar', adjustment='mul', offset=0):
+        
+        sessions = pd.DatetimeIndex(bars['close'].index)
+        days = sessions.values.astype('datetime64[D]').astype(np.int64)
+        auto_close = pd.to_datetime(auto_close_dates).values.astype('datetime64[D]').astype(np.int64)
+        raw = dict((field, np.asarray(bars[field], dtype=float)) for field in CONTINUOUS_FUTURES_FIELDS)
+        contracts = np.asarray(bars['close'].columns, dtype=np.int64)
+        last = len(contracts) - 1
+        
+        # Active contract of every session (the front contract, then offset contracts further out)
+        front = 0
+        active = np.empty(len(days), dtype=np.intp)
+        for t in range(len(days)):
+            while front < last and (days[t] >= auto_close[front] or 
+                                    (roll == 'volume' and t > 0 and raw['volume'][t - 1, front + 1] > raw['volume'][t - 1, front])):
+                front += 1
+            active[t] = min(front + offset, last)
+        
+        # Cumulative adjustment of every session for the rolls after it: the adjusted series seen on 
+        # session t is stored[:t + 1] / scale[t] ('mul') or stored[:t + 1] - scale[t] ('add')
+        rolls = np.flatnonzero(active[1:] != active[:-1]) + 1
+        step = np.zeros(len(days)) if adjustment == 'add' else np.ones(len(days))
+        if adjustment in ('mul', 'add') and len(rolls):
+            before, after = raw['close'][rolls - 1, active[rolls - 1]], raw['close'][rolls - 1, active[rolls]]
+            change = after / before if adjustment == 'mul' else after - before
+            step[rolls - 1] = np.where(np.isfinite(change), change, step[rolls - 1])
+        scale = np.cumsum(step[::-1])[::-1] if adjustment == 'add' else np.cumprod(step[::-1])[::-1]
+        
+        key = ContinuousFutureStore.key(root_symbol, roll, adjustment, offset)
+        rows = np.arange(len(days))
+        np.save('%s/%s.sessions.npy' % (path, key), days)
+        np.save('%s/%s.contract.npy' % (path, key), contracts[active])
+        np.save('%s/%s.scale.npy' % (path, key), scale)
+        for field in CONTINUOUS_FUTURES_FIELDS:
+            values = raw[field][rows, active]
+            if field != 'volume':
+                values = values + scale if adjustment == 'add' else values * scale
+            np.save('%s/%s.%s.npy' % (path, key, field), values)
+    
+    # Position of session day (a date) in the series, which must cover it
+    def _locate(self, series, day):
+        day = np.datetime64(pd.Timestamp(day).date(), 'D').astype(np.int64)
+        t = np.searchsorted(series['sessions'], day)
+        if t == len(series['sessions']) or series['sessions'][t] != day:
+            raise KeyError('%s is not a session of the continuous futures store' % pd.Timestamp(day, unit='D').date())
+        return t
+    
+    # The bars sessions before day of field, adjusted as seen on day (OHLC and price are rescaled, 
+    # volume is not)
+    def history(self, future, field, day, bars):
+        series = self._series(future)
+        t = self._locate(series, day)
+        window = series[field][max(t - bars, 0):t]
+        if field == 'volume' or future.adjustment not in ('mul', 'add'):
+            return window
+        return window / series['scale'][t] if future.adjustment == 'mul' else window - series['scale'][t]
+    
+    # Sessions of the same window as history
+    def sessions(self, future, day, bars):
+        series = self._series(future)
+        t = self._locate(series, day)
+        return pd.DatetimeIndex(np.asarray(series['sessions'][max(t - bars, 0):t]).astype('datetime64[D]'), tz='UTC')
+    
+    # sid of the contract future trades on day
+    def contract(self, future, day):
+        series = self._series(future)
+        return series['contract'][self._locate(series, day)]
+
+CONTINUOUS_FUTURES_STORE = ContinuousFutureStore(CONTINUOUS_FUTURES_STORE_PATH) if CONTINUOUS_FUTURES_STORE_PATH else None
+
+
+# Same as data.history(futures, fields, bars, '1d'), read from the store when there is one: the 
+# completed sessions come from the store and today's bar from data.current. A list of fields 
+# returns a dict of DataFrames (indexed like the Panel data.history returns: [field][future])
+def future_history(data, futures, fields, bars):
+    
+    if CONTINUOUS_FUTURES_STORE is None:
+        return data.history(futures, fields, bars, '1d')
+    
+    today = get_datetime().normalize()
+    frames = {}
+    for field in ([fields] if isinstance(fields, str) else fields):
+        block = np.column_stack([CONTINUOUS_FUTURES_STORE.history(future, field, today, bars - 1) for future in futures])
+        current = np.asarray(data.current(futures, field), dtype=float)
+        index = CONTINUOUS_FUTURES_STORE.sessions(futures[0], today, bars - 1).append(pd.DatetimeIndex([today]))
+        frames[field] = pd.DataFrame(np.vstack([block, current]), index=index, columns=futures)
+    return frames[fields] if isinstance(fields, str) else frames
+
+
+# Same as data.current(futures, 'contract'), from the store's contract calendar when there is one
+def future_contracts(data, futures):
+    
+    if CONTINUOUS_FUTURES_STORE is None:
+        return data.current(futures, 'contract')
+    
+    today = get_datetime().normalize()
+    return pd.Series([sid(CONTINUOUS_FUTURES_STORE.contract(future, today)) for future in futures], index=futures)
+
+# N (AVERAGE TRUE RANGE) ENGINE
+#------------------------------
+# Wilder's smoothed true range for every market at once: one array holds each market's N, the 
+# last close and the warm-up sums, and every completed daily bar is one vectorized step for all 
+# markets. The first N is the average of the first `period` true ranges, then 
+# N = (N * (period - 1) + TR) / period, which is what talib's ATR gives over the whole history. 
+# peek() gives N including today's bar so far without committing it. With 'mul' adjustment a roll 
+# rescales the whole history, so rescale() scales the state (all of it prices) by the same ratio, 
+# taken on the session of each market's last close (close_sessions), which is the last stepped 
+# session unless that bar was missing. checkpoint() / from_checkpoint() save and restore the state, so a backtest can restart mid-way 
+# without replaying the history.
+class WilderATR(object):
+    
+    def __init__(self, count, period=20):
+        self.period = period
+        self.atr = np.full(count, np.nan)
+        self.prev_close = np.full(count, np.nan)
+        self.tr_sum = np.zeros(count)
+        self.tr_count = np.zeros(count, dtype=np.int64)
+        self.close_sessions = np.full(count, None, dtype=object)
+        self.last_session = None
+    
+    # True range against the previous close (NaN for a market without one yet)
+    def _true_range(self, high, low):
+        return np.maximum(high - low, np.maximum(np.abs(high - self.prev_close), np.abs(low - self.prev_close)))
+    
+    # One completed bar for every market (NaN bars leave a market's state as it is)
+    def update(self, high, low, close, session=None):
+        high, low, close = [np.asarray(x, dtype=float) for x in (high, low, close)]
+        tr = self._true_range(high, low)
+        valid = np.isfinite(tr)
+        
+        warming = valid & (self.tr_count < self.period)
+        self.tr_sum[warming] += tr[warming]
+        self.tr_count[warming] += 1
+        seeded = warming & (self.tr_count == self.period)
+        self.atr[seeded] = self.tr_sum[seeded] / self.period
+        
+        smoothed = valid & ~warming
+        self.atr[smoothed] += (tr[smoothed] - self.atr[smoothed]) / self.period
+        
+        self.prev_close = np.where(np.isfinite(close), close, self.prev_close)
+        if session is not None:
+            self.close_sessions[np.isfinite(close)] = session
+            self.last_session = session
+        return self.atr
+    
+    # Several completed bars, one row per bar (e.g. the warm-up window)
+    def update_many(self, highs, lows, closes, sessions=None):
+        for i in range(len(highs)):
+            self.update(highs[i], lows[i], closes[i], None if sessions is None else sessions[i])
+        return self.atr
+    
+    # N with the bar in progress (high and low so far) counted, without changing the state
+    def peek(self, high, low):
+        tr = self._true_range(np.asarray(high, dtype=float), np.asarray(low, dtype=float))
+        seeded = np.where(self.tr_count == self.period - 1, (self.tr_sum + tr) / self.period, np.nan)
+        stepped = self.atr + (tr - self.atr) / self.period
+        return np.where(np.isfinite(tr), np.where(np.isnan(self.atr), seeded, stepped), self.atr)
+    
+    # The history of every market was re-adjusted by ratio (NaN ratios leave a market as it is)
+    def rescale(self, ratio):
+        ratio = np.where(np.isfinite(ratio), ratio, 1.0)
+        self.atr *= ratio
+        self.prev_close *= ratio
+        self.tr_sum *= ratio
+    
+    def checkpoint(self):
+        return {'period': self.period, 'atr': self.atr.copy(), 'prev_close': self.prev_close.copy(), 
+                'tr_sum': self.tr_sum.copy(), 'tr_count': self.tr_count.copy(), 
+                'close_sessions': self.close_sessions.copy(), 'last_session': self.last_session}
+    
+    @staticmethod
+    def from_checkpoint(state):
+        engine = WilderATR(len(state['atr']), state['period'])
+        for name in ['atr', 'prev_close', 'tr_sum', 'tr_count']:
+            setattr(engine, name, np.array(state[name]))
+        engine.last_session = state['last_session']
+        if 'close_sessions' in state:
+            engine.close_sessions = np.array(state['close_sessions'], dtype=object)
+        else:
+            engine.close_sessions[np.isfinite(engine.prev_close)] = engine.last_session
+        return engine
+
+# DONCHIAN CHANNEL ENGINE
+#------------------------
+# Rolling highs and lows of the last n completed days (n = 10, 20 and 55 by default) for every 
+# market. Each channel side is a monotonic deque of (bar, value) per market: a new bar pops the 
+# values it dominates from the back and expired bars from the front, so the extreme is always at 
+# the front. That is amortized O(1) per bar instead of a window scan on every call. A channel is 
+# NaN until it has seen n bars. breakouts() counts today's bar so far on top of the channel, the 
+# same way the rolling windows of data.history did, and returns the flags of all markets as 
+# boolean arrays. rescale() follows a roll's back-adjustment, like WilderATR.rescale.
+class DonchianChannels(object):
+    
+    def __init__(self, count, windows=(10, 20, 55)):
+        self.windows = windows
+        self.bars = 0
+        self.last_session = None
+        self.high_deques = dict((window, [deque() for _ in range(count)]) for window in windows)
+        self.low_deques = dict((window, [deque() for _ in range(count)]) for window in windows)
+        self.upper = dict((window, np.full(count, np.nan)) for window in windows)
+        self.lower = dict((window, np.full(count, np.nan)) for window in windows)
+    
+    # Push value of bar onto a max deque (sign=1) or min deque (sign=-1) and drop bars older than window
+    @staticmethod
+    def _push(queue, bar, value, window, sign):
+        if value == value:
+            while queue and sign * queue[-1][1] <= sign * value:
+                queue.pop()
+            queue.append((bar, value))
+        while queue and queue[0][0] <= bar - window:
+            queue.popleft()
+        return queue[0][1] if queue else np.nan
+    
+    # One completed bar for every market
+    def update(self, high, low, session=None):
+        for window in self.windows:
+            highs, lows = self.high_deques[window], self.low_deques[window]
+            upper, lower = self.upper[window], self.lower[window]
+            for i in range(len(upper)):
+                upper[i] = self._push(highs[i], self.bars, high[i], window, 1)
+                lower[i] = self._push(lows[i], self.bars, low[i], window, -1)
+            if self.bars + 1 < window:
+                upper[:] = np.nan
+                lower[:] = np.nan
+        self.bars += 1
+        if session is not None:
+            self.last_session = session
+    
+    # The history of every market was re-adjusted by ratio (positive, so every deque stays monotonic)
+    def rescale(self, ratio):
+        for i in np.flatnonzero(np.isfinite(ratio) & (ratio != 1.0)):
+            for window in self.windows:
+                for queue in (self.high_deques[window][i], self.low_deques[window][i]):
+                    for k in range(len(queue)):
+                        queue[k] = (queue[k][0], queue[k][1] * ratio[i])
+                self.upper[window][i] *= ratio[i]
+                self.lower[window][i] *= ratio[i]
+    
+    # (price at or above the window-day high, price at or below the window-day low) for every market, 
+    # with today's high and low so far included in the channel
+    def breakouts(self, price, high, low, window):
+        price = np.asarray(price, dtype=float)
+        upper = np.maximum(self.upper[window], np.asarray(high, dtype=float))
+        lower = np.minimum(self.lower[window], np.asarray(low, dtype=float))
+        return price >= upper, price <= lower
+
+# MARKET SNAPSHOT
+#-----------------
+# Everything rebalance reads about the market on one bar: a single daily history fetch of every 
+# field over the widest window needed, kept as (bars x futures) arrays, so narrower windows, 
+# today's values and the values of a past session (as adjusted today, which is what a roll changes) 
+# are slices of it. Contract resolution is done once for the bar and memoized.
+class MarketSnapshot(object):
+    
+    def __init__(self, data, futures, fields, bars):
+        self.data = data
+        self.futures = futures
+        history = future_history(data, futures, fields, bars)
+        self.sessions = history[fields[0]].index
+        self.arrays = dict((field, history[field][futures].values) for field in fields)
+        self._contracts = None
+    
+    # The last bars rows of field (all of them by default), today's bar so far included
+    def window(self, field, bars=None):
+        return self.arrays[field] if bars is None else self.arrays[field][-bars:]
+    
+    # Today's value of field for every future
+    def current(self, field):
+        return self.arrays[field][-1]
+    
+    # The value of field for every future on its own session, as adjusted today (NaN for a future 
+    # whose session is not in self.sessions)
+    def values(self, field, sessions):
+        rows = self.sessions.get_indexer(sessions)
+        values = self.arrays[field][rows.clip(0), np.arange(len(rows))]
+        return np.where(rows >= 0, values, np.nan)
+    
+    # Current contract of every future (a Series indexed by future)
+    def contracts(self):
+        if self._contracts is None:
+            self._contracts = future_contracts(self.data, self.futures)
+        return self._contracts
 
 
 def initialize(context):
@@ -83,6 +409,13 @@ def initialize(context):
                           context.wheat_emini,
                           ]  
     
+    # N (20-day Wilder ATR) state of every future, warmed up on the first rebalance
+    context.atr = WilderATR(len(context.my_futures), period=20)
+    
+    # 10, 20 and 55-day high/low channels of every future (System 1 uses the 20-day entry and 
+    # 10-day exit channels, System 2 the 55-day and 20-day ones)
+    context.channels = DonchianChannels(len(context.my_futures), windows=(10, 20, 55))
+    
     
     # (Equity market it open for 6 hours and 30 minutes) 8:30am - 3:00pm
     # This is also the time of day where the futures market is the MOST liquid
@@ -108,20 +441,65 @@ def initialize(context):
     
 
 def rebalance(context, data):
-        
-    # Return the 20-day 'high', 'low', and 'close' for True Range calculation
-    price_history = data.history(context.my_futures, ['high', 'low', 'close', 'price'], 21, '1d') 
     
-    # Return the 10-day 'price' history of our futures
-    recent_prices = data.history(context.my_futures, ['high', 'low', 'price'], 10, '1d') 
+    atr, channels = context.atr, context.channels
+    
+    # Return the 'high', 'low', 'close' and 'price' history of our futures in one fetch: long enough 
+    # to warm up the 55-day channel the first time, afterwards only the last few days (today's bar so 
+    # far and the completed days that are not in the ATR and channel states yet)
+    fields = ['high', 'low', 'close', 'price']
+    warm_up = max(channels.windows) + 2
+    snapshot = MarketSnapshot(data, context.my_futures, fields, warm_up if atr.last_session is None else 5)
+    
+    # The last close of every market has to be in the snapshot to reconcile the states with a roll, 
+    # so a market that has been missing bars for a few days needs a longer snapshot, and after a 
+    # longer gap than that the states are warmed up again from scratch
+    closed = pd.notnull(atr.close_sessions)
+    if atr.last_session is not None and (snapshot.sessions.get_indexer(atr.close_sessions[closed]) < 0).any():
+        snapshot = MarketSnapshot(data, context.my_futures, fields, warm_up)
+    if atr.last_session is not None and atr.last_session not in snapshot.sessions[:-1]:
+        context.atr = atr = WilderATR(len(context.my_futures), atr.period)
+        context.channels = channels = DonchianChannels(len(context.my_futures), channels.windows)
+        snapshot = MarketSnapshot(data, context.my_futures, fields, warm_up)
     
     # Return the current contract of each of our futures
-    contracts = data.current(context.my_futures, 'contract')
+    contracts = snapshot.contracts()
+    
+    
+    # N AND CHANNEL STATE
+    #---------------------
+    # Completed days are stepped into the ATR and channel states once, and today's bar so far is 
+    # counted on top of them
+    completed = snapshot.sessions[:-1]
+    highs, lows, closes = [snapshot.window(field) for field in ['high', 'low', 'close']]
+    
+    # A roll since the last stepped day back-adjusts the history, so the states are rescaled by each 
+    # market's last stored close as adjusted today over that close (a ratio of 1 without a roll). The 
+    # ratio is taken on the session of that close, since a missing bar leaves the close of the last 
+    # stepped day NaN
+    if atr.last_session is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = snapshot.values('close', atr.close_sessions) / atr.prev_close
+        atr.rescale(ratios)
+        channels.rescale(ratios)
+    
+    for row in range(len(completed)):
+        if atr.last_session is None or completed[row] > atr.last_session:
+            atr.update(highs[row], lows[row], closes[row], session=completed[row])
+            channels.update(highs[row], lows[row], session=completed[row])
+    
+    # N is the 20-Day Average True Range
+    Ns = atr.peek(snapshot.current('high'), snapshot.current('low'))
+    
+    # Breakouts of the 20-day channel (entries) and the 10-day channel (exits)
+    prices = snapshot.current('price')
+    highs_20, lows_20 = channels.breakouts(prices, snapshot.current('high'), snapshot.current('low'), 20)
+    highs_10, lows_10 = channels.breakouts(prices, snapshot.current('high'), snapshot.current('low'), 10)
     
 
     # TRADE LOGIC
     #-------------
-    for future in context.my_futures:
+    for i, future in enumerate(context.my_futures):
         
         # Position size constraints
         starting_cash = context.portfolio.starting_cash
@@ -129,14 +507,7 @@ def rebalance(context, data):
    
         future_contract = contracts[future]          
                
-        # N CALCULATION (VOLATILITY METRIC)
-        #---------------------------------
-        highs = price_history['high'][future]
-        lows = price_history['low'][future]
-        closes = price_history['close'][future]
-
-        # N is the 20-Day Average True Range    
-        N = ATR(highs, lows, closes, timeperiod=20)[-1]     
+        N = Ns[i]
     
         if np.isnan(N):
             continue
@@ -150,7 +521,7 @@ def rebalance(context, data):
         # Unit Calculation 
         unit = math.floor(position_size / dV)
  
-        price = data.current(future, 'price')
+        price = prices[i]
 
         
         # Logs to see the price and unit data every time the function is called
@@ -159,11 +530,11 @@ def rebalance(context, data):
         # log.info("The 20-day low of %s is: " % (future_contract.asset_name) + str(min(price_history['low'][future]))
         # log.info("Current unit of %s is: " % (future_contract.asset_name) + str(unit))
     
-        high_20 = True if price >= max(price_history['high'][future]) else False
-        low_20 = True if price <= min(price_history['low'][future]) else False
+        high_20 = highs_20[i]
+        low_20 = lows_20[i]
         
-        high_10 = True if price >= max(recent_prices['high'][future]) else False
-        low_10 = True if price <= min(recent_prices['low'][future]) else False
+        high_10 = highs_10[i]
+        low_10 = lows_10[i]
 
         
         # ENTRY STRATEGY
@@ -197,14 +568,15 @@ def rebalance(context, data):
         
         # CHECK POSITIONS
         #-----------------
-        current_position = context.portfolio.positions[data.current(context.my_futures, 'contract')[future]]
+        current_position = context.portfolio.positions[contracts[future]]
         current_contract = current_position.asset        
 
         if current_contract in context.portfolio.positions and data.can_trade(current_contract) and not get_open_orders(current_contract):
             
             # Positon details
             cost_basis = context.portfolio.positions[current_contract].cost_basis             
-            price = data.current(current_contract, 'price')
+            # (the contract held is the future's current contract, so its price is the future's)
+            price = prices[i]
             holding = context.portfolio.positions[current_contract].amount
             
             long_position = True if holding > 0 else False
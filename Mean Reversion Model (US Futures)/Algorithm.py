@@ -14,7 +14,6 @@ import numpy as np
 import pandas as pd
 
 import quantopian.optimize as opt
-from statsmodels.tsa.stattools import coint
 from quantopian.algorithm import order_optimal_portfolio
 
 # Initialize funciton (ran at the beginning of the algo)
@@ -35,24 +34,10 @@ def initialize(context):
          continuous_future('BO', offset=0, roll='calendar', adjustment='mul'))
     ]
     
-    # Deconstruct every group of pairs into one comprehensive list using itertools -- this list is 
-    # called later in the rebalance function to store price data for each futures contract
-    context.futures_list = list(itertools.chain.from_iterable(context.futures_pairs))
-    
-    # Initialize both the "inLong" dict and the "inShort" dict to False at the beginning
-    # since we start with no positions in the portfolio -- this is updated as we order
-    # and used to check True or False if we are already making a trade in one way to 
-    # prevent the algorithm from trying to make a long or short bet on the same pair twice
-    # at the same time
-    context.inLong = {(pair[0].root_symbol, pair[1].root_symbol): False 
-                      for pair in context.futures_pairs}    
-    
-    context.inShort = {(pair[0].root_symbol, pair[1].root_symbol): False 
-                       for pair in context.futures_pairs}
-    
-    # Initialize weights for all futures to 0 in a dictionary
-    context.long_term_weights = {cont_future.root_symbol: 0 for cont_future in context.futures_list}
-    context.current_weights = {}
+    # The book starts every pair flat with 0 weight on both legs -- the position is updated as we 
+    # order and used to check if we are already making a trade in one way, to prevent the algorithm 
+    # from trying to make a long or short bet on the same pair twice at the same time
+    context.book = PairBook(context.futures_pairs)
         
     # Strategic lookback periods that can be easily adjusted 
     # (2 months of trading days)
@@ -60,6 +45,13 @@ def initialize(context):
     # (1 week of trading days)
     context.short_ma = 5
     
+    # How each pair estimates its hedge ratio and zscore: 'ols' refits the regression on the last 42 days
+    # every time (and re-tests the pair for cointegration), 'kalman' steps a streaming Kalman filter with 
+    # the current prices only (see KalmanHedge below)
+    context.hedge_modes = {(pair[0].root_symbol, pair[1].root_symbol): 'ols' 
+                           for pair in context.futures_pairs}
+    context.kalman = KalmanHedge(len(context.futures_pairs), context.short_ma, context.long_ma)
+    
     # Schedule the rebalance_pairs function everyday, 60 minutes after the market open
     schedule_function(func=rebalance_pairs, 
                       date_rule=date_rules.every_day(), 
@@ -71,148 +63,159 @@ def initialize(context):
 def rebalance_pairs(context, data):
     
     
-    # Dataframe of historical prices (42 days per our definition) for every future that we are trading (futures_list)
-    # Since we call the rebalance everyday, the prices in this dataframe will be rolling with time
-    prices = data.history(context.futures_list, 'price', context.long_ma, '1d')
+    # Hedge ratio, zscore, latest prices and cointegration pvalue of every pair (kalman pairs are not 
+    # re-tested, their pvalue stays at 0)
+    pairs = context.futures_pairs
+    hedge_ratios, zscores = np.full(len(pairs), np.nan), np.full(len(pairs), np.nan)
+    y_prices, x_prices = np.full(len(pairs), np.nan), np.full(len(pairs), np.nan)
+    pvalues = np.zeros(len(pairs))
+    modes = [context.hedge_modes[(future_y.root_symbol, future_x.root_symbol)] for future_y, future_x in pairs]
     
-    # For each pair in futures_pairs, store the array of 42 day price history (prices) in Y,X variables respectively
-    for future_y, future_x in context.futures_pairs:
-        Y = prices[future_y]
-        X = prices[future_x]
-        
-        # Take the log of the prices, these are used for an on the fly cointegration test below
-        y_log = np.log(Y)
-        x_log = np.log(X)
-        
-        # For each pair in futures_pairs, test for cointegration and return the status. If the pair 
-        # goes through the cointegration test and has a pvalue greater than 0.05, they are definitely
-        # no longer cointegrated and the "continue" statement skips this pair and reiterates the "for"
-        # loop above -- for future_y, future_x in context.futures_pairs
-        pvalue = coint(y_log, x_log)[1]
-        if pvalue > 0.05:
-            log.info('({} {}) are no longer cointegrated, no trades placed on this pair.'.format(future_y.root_symbol, 
-                                                                                                  future_x.root_symbol))                                                                              
-            continue
+    # 'ols' pairs: dataframe of historical prices (42 days per our definition) for every future in these pairs
+    # Since we call the rebalance everyday, the prices in this dataframe will be rolling with time
+    ols = [i for i, mode in enumerate(modes) if mode == 'ols']
+    if ols:
+        futures_y = [pairs[i][0] for i in ols]
+        futures_x = [pairs[i][1] for i in ols]
+        prices = future_history(data, list(set(futures_y + futures_x)), 'price', context.long_ma)
+        Y = prices[futures_y].values
+        X = prices[futures_x].values
         
-        # Since the pairs are deemd to be cointegrated, run a linear regression on the log of the
-        # recent 42 day prices for X and Y
-        regression = sp.stats.linregress(x_log[-context.long_ma:], 
-                                         y_log[-context.long_ma:])
-      
-        # Since this is a continual algorithm meant to be run across multiple time periods,
-        # retrieve and store the current contract that is being traded in the market
-        future_y_contract, future_x_contract = data.current([future_y, future_x], 'contract')
+        # Take the log of the prices and test every pair for cointegration in one batch -- the test also
+        # returns the slope of the regression of log(Y) on log(X) over the 42 days, which is the hedge ratio
+        tstats, pvalues[ols], hedge_ratios[ols] = coint_batch(np.log(Y), np.log(X))
         
         # Spread equals the price of Y - (X * slope of regression)
         # y = mx + b    ==>    y - mx = b    ==>   b = y - mx                                                            
-        spreads = Y - (regression.slope * X)
+        spreads = Y - (hedge_ratios[ols] * X)
         
         # Calculate the zscore of the spreads for mean reversion trading signals
-        zscore = (np.mean(spreads[-context.short_ma:]) - np.mean(spreads)) / np.std(spreads, ddof=1)
+        zscores[ols] = (np.mean(spreads[-context.short_ma:], axis=0) - np.mean(spreads, axis=0)) / np.std(spreads, axis=0, ddof=1)
+        y_prices[ols] = Y[-1]
+        x_prices[ols] = X[-1]
+    
+    # 'kalman' pairs: one filter step on the current prices. A pair is (re)seeded from 42 days of history 
+    # instead when it is new or one of its legs has rolled to another contract since the last step
+    kalman = [i for i, mode in enumerate(modes) if mode == 'kalman']
+    if kalman:
+        futures_y = [pairs[i][0] for i in kalman]
+        futures_x = [pairs[i][1] for i in kalman]
+        y_prices[kalman] = data.current(futures_y, 'price').values
+        x_prices[kalman] = data.current(futures_x, 'price').values
+        contracts = zip(future_contracts(data, futures_y), future_contracts(data, futures_x))
+        
+        stepped = []
+        for i, legs in zip(kalman, contracts):
+            if context.kalman.contracts[i] == legs:
+                stepped.append(i)
+                continue
+            history = future_history(data, list(pairs[i]), 'price', context.long_ma)
+            context.kalman.seed(i, history[pairs[i][0]].values, history[pairs[i][1]].values, legs)
         
-        # Initialize the root_symbol of each contract in the pair into the current_weights dictionary       
-        context.current_weights[future_y_contract] = context.long_term_weights[future_y_contract.root_symbol]
-        context.current_weights[future_x_contract] = context.long_term_weights[future_x_contract.root_symbol]
+        hedge_ratios[kalman], zscores[kalman] = context.kalman.signals(kalman)
+        if stepped:
+            hedge_ratios[stepped], zscores[stepped] = context.kalman.update(stepped, y_prices[stepped], x_prices[stepped])
+    
+    # Since this is a continual algorithm meant to be run across multiple time periods, retrieve the 
+    # current contract that is being traded in the market for every root symbol -- a roll swaps the 
+    # contract in place in the book
+    book = context.book
+    book.roll(future_contracts(data, book.futures))
+    
+    # For each pair in futures_pairs, act on its hedge ratio and zscore
+    for i, (future_y, future_x) in enumerate(pairs):
+        hedge_ratio = hedge_ratios[i]
+        zscore = zscores[i]
+        
+        # If the pair went through the cointegration test and has a pvalue greater than 0.05, they are 
+        # definitely no longer cointegrated and the "continue" statement skips this pair and reiterates 
+        # the "for" loop above -- for future_y, future_x in context.futures_pairs
+        if pvalues[i] > 0.05:
+            log.info('({} {}) are no longer cointegrated, no trades placed on this pair.'.format(future_y.root_symbol, 
+                                                                                                  future_x.root_symbol))                                                                              
+            continue
         
-        # Save the coefficient of the linear combination for later use
-        hedge_ratio = regression.slope
+        # Contracts of both legs, as held in the book (multipliers are used to size the legs below)
+        future_y_contract, future_x_contract = [book.contracts[slot] for slot in book.legs[i]]
 
         
 # Trading Algorithms        
 #-------------------------------------------------------------------------------------------------        
-        # If the pair is in the short list AND the zscore of the spread is LESS THAN 0 (NEGATIVE):
-        if context.inShort[(future_y.root_symbol, future_x.root_symbol)] and zscore < 0.0:
+        # If the pair is short the spread AND the zscore of the spread is LESS THAN 0 (NEGATIVE):
+        if book.position[i] == -1 and zscore < 0.0:
             
-            # Set the weight for both contracts equal to 0 -- this is based on the economic theory that
+            # Set the weight for both legs equal to 0 -- this is based on the economic theory that
             # if we are already shorting the spread, when the zscore is negative we want to exit all positions
-            context.long_term_weights[future_y_contract.root_symbol] = 0
-            context.long_term_weights[future_x_contract.root_symbol] = 0
-            context.current_weights[future_y_contract] = context.long_term_weights[future_y_contract.root_symbol]
-            context.current_weights[future_x_contract] = context.long_term_weights[future_x_contract.root_symbol]
-            
-            # Ensure the pair is no longer in either the long or short baskets
-            context.inLong[(future_y.root_symbol, future_x.root_symbol)] = False
-            context.inShort[(future_y.root_symbol, future_x.root_symbol)] = False
+            # Ensure the pair is no longer long or short
+            book.leg_weights[i] = 0
+            book.position[i] = 0
             continue
                                     
         #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-        # If the pair is in the long list AND the zscore of the spread is GREATER THAN 0 (POSTIVE):
-        if context.inLong[(future_y.root_symbol, future_x.root_symbol)] and zscore > 0.0:
+        # If the pair is long the spread AND the zscore of the spread is GREATER THAN 0 (POSTIVE):
+        if book.position[i] == 1 and zscore > 0.0:
             
-            # Set the weight for both contracts equal to 0 -- this is based on the economic theory that
+            # Set the weight for both legs equal to 0 -- this is based on the economic theory that
             # if we are already long the spread, when the zscore is positive we want to exit all positions
-            context.long_term_weights[future_y_contract.root_symbol] = 0
-            context.long_term_weights[future_x_contract.root_symbol] = 0
-            context.current_weights[future_y_contract] = context.long_term_weights[future_y_contract.root_symbol]
-            context.current_weights[future_x_contract] = context.long_term_weights[future_x_contract.root_symbol]
-            
-            # Ensure the pair is no longer in either the long or short baskets
-            context.inLong[(future_y.root_symbol, future_x.root_symbol)] = False
-            context.inShort[(future_y.root_symbol, future_x.root_symbol)] = False
+            # Ensure the pair is no longer long or short
+            book.leg_weights[i] = 0
+            book.position[i] = 0
             continue
             
 #------------------------------------------------------------------------------------------------- 
-        # If the zscore of the spread is LESS THAN -1, AND pair is not already in the long basket:
-        if zscore < -1.0 and (not context.inLong[(future_y.root_symbol, future_x.root_symbol)]):
+        # If the zscore of the spread is LESS THAN -1, AND pair is not already long the spread:
+        if zscore < -1.0 and book.position[i] != 1:
             
             # Number of respective futures shares (used below in computeHoldingsPct)
             y_target_contracts = 1
             x_target_contracts = hedge_ratio
             
-            # Put the pairs into the long list now that we are longing them
-            context.inLong[(future_y.root_symbol, future_x.root_symbol)] = True
-            context.inShort[(future_y.root_symbol, future_x.root_symbol)] = False
+            # Mark the pair as long now that we are longing it, with the hedge ratio it was entered at
+            book.position[i] = 1
+            book.hedge_ratio[i] = hedge_ratio
             
             # The target percentages are derived from the computeHoldingsPct function taking 
             # number of Y contracts, number of X contracts, (yPrice * yMultiplier), (xPrice * yMultiplier)
             (y_target_pct, x_target_pct) = computeHoldingsPct(y_target_contracts, 
                                                               x_target_contracts, 
-                                                              future_y_contract.multiplier * Y[-1], 
-                                                              future_x_contract.multiplier * X[-1])
+                                                              future_y_contract.multiplier * y_prices[i], 
+                                                              future_x_contract.multiplier * x_prices[i])
 
             # Since we are now placing a long spread bet, we are going to buy Y at the target percent and
             # we are going to sell X at the target percent
-            context.long_term_weights[future_y_contract.root_symbol] = y_target_pct
-            context.long_term_weights[future_x_contract.root_symbol] = -x_target_pct
-            context.current_weights[future_y_contract] = context.long_term_weights[future_y_contract.root_symbol]
-            context.current_weights[future_x_contract] = context.long_term_weights[future_x_contract.root_symbol]
+            book.leg_weights[i] = (y_target_pct, -x_target_pct)
             continue
                         
         #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-        # If the zscore of the spread is GREATER THAN 1, AND pair is not already in the short basket:
-        if zscore > 1.0 and (not context.inShort[(future_y.root_symbol, future_x.root_symbol)]):
+        # If the zscore of the spread is GREATER THAN 1, AND pair is not already short the spread:
+        if zscore > 1.0 and book.position[i] != -1:
             
             # Number of respective futures shares (used below in computeHoldingsPct)
             y_target_contracts = 1
             x_target_contracts = hedge_ratio
             
-            # Put the pairs into the short list now that we are shorting them
-            context.inLong[(future_y.root_symbol, future_x.root_symbol)] = False
-            context.inShort[(future_y.root_symbol, future_x.root_symbol)] = True
+            # Mark the pair as short now that we are shorting it, with the hedge ratio it was entered at
+            book.position[i] = -1
+            book.hedge_ratio[i] = hedge_ratio
             
             # The target percentages are derived from the computeHoldingsPct function taking 
             # number of Y contracts, number of X contracts, (yPrice * yMultiplier), (xPrice * yMultiplier)
             (y_target_pct, x_target_pct) = computeHoldingsPct(y_target_contracts, 
                                                               x_target_contracts, 
-                                                              future_y_contract.multiplier * Y[-1], 
-                                                              future_x_contract.multiplier * X[-1])
+                                                              future_y_contract.multiplier * y_prices[i], 
+                                                              future_x_contract.multiplier * x_prices[i])
                 
-            # Since we are now placing a long spread bet, we are going to sell Y at the target percent and
-            # we are going to buy X at the target percent. We store the target values in the long-term weights, 
-            # and then transfer them to current_weights
-            context.long_term_weights[future_y_contract.root_symbol] = -y_target_pct
-            context.long_term_weights[future_x_contract.root_symbol] = x_target_pct
-            context.current_weights[future_y_contract] = context.long_term_weights[future_y_contract.root_symbol]
-            context.current_weights[future_x_contract] = context.long_term_weights[future_x_contract.root_symbol]
+            # Since we are now placing a short spread bet, we are going to sell Y at the target percent and
+            # we are going to buy X at the target percent
+            book.leg_weights[i] = (-y_target_pct, x_target_pct)
             continue
             
 #------------------------------------------------------------------------------------------------- 
     
-    # Calculate the adjusted weights and store them in a series that will be used for target weights in the portfolio.
-    # We need to divide each weight stored in current_weights by the length of the pairs. In the calculations the
-    # pairs are seen as individual units so each futures weight needs to be divided by the length of the pairs to 
-    # get the ACTUAL weight in the overall portfolio
-    adjusted_weights = pd.Series({i: w / (len(context.futures_pairs)) for i, w in context.current_weights.items()})
+    # Calculate the adjusted weights of every contract from the leg weights of all pairs. In the calculations 
+    # the pairs are seen as individual units, so each futures weight is divided by the number of pairs to 
+    # get the ACTUAL weight in the overall portfolio. The series is a view of the book's weight array
+    adjusted_weights = book.update_targets()
         
     # Using optimize api to order based on the adjusted_weights above, making sure to contrain net leverage to 1.0
     order_optimal_portfolio(opt.TargetWeights(adjusted_weights), constraints=[opt.MaxGrossExposure(1.0)])
@@ -221,6 +224,334 @@ def rebalance_pairs(context, data):
     log.info('weights: ', adjusted_weights)
     record(Exposure = context.account.net_leverage)
     
+# Roll-adjusted continuous futures store (offline backtests)
+#-----------------------------------------------------------
+# data.history on a continuous future stitches the contracts and applies the back-adjustment on 
+# every call, and data.current(..., 'contract') resolves the active contract again every bar. 
+# ContinuousFutureStore.build does the stitching once per root and roll rule, offline. It writes 
+# .npy arrays holding the sessions, the active contract of every session, the adjusted OHLC, 
+# price and volume series and the cumulative adjustment. Loaded with mmap_mode='r', a backtest 
+# (or every process of a parameter sweep) reads a window as a slice plus one rescale, and the 
+# contract as one lookup. The Quantopian IDE has no file access, so there 
+# CONTINUOUS_FUTURES_STORE_PATH stays None and future_history / future_contracts fall back to 
+# data.history / data.current.
+CONTINUOUS_FUTURES_STORE_PATH = None
+CONTINUOUS_FUTURES_FIELDS = ['open', 'high', 'low', 'close', 'price', 'volume']
+
+class ContinuousFutureStore(object):
+    
+    def __init__(self, path):
+        self.path = path
+        self.series = {}
+    
+    @staticmethod
+    def key(root_symbol, roll, adjustment, offset=0):
+        return '%s_%s_%s_%d' % (root_symbol, roll, adjustment, offset)
+    
+    # Arrays of one continuous future, loaded (memory-mapped) on first use
+    def _series(self, future):
+        key = self.key(future.root_symbol, future.roll_style, future.adjustment, future.offset)
+        if key not in self.series:
+            self.series[key] = dict((name, np.load('%s/%s.%s.npy' % (self.path, key, name), mmap_mode='r')) 
+                                    for name in ['sessions', 'contract', 'scale'] + CONTINUOUS_FUTURES_FIELDS)
+        return self.series[key]
+    
+    # bars: {FIELD: DataFrame of raw daily bars, one row per session and one column per contract sid,
+    #        columns in expiration order}
+    # auto_close_dates: auto close date of each contract (same order as the columns)
+    # roll: 'calendar' rolls on the front contract's auto close date, 'volume' rolls as soon as the 
+    #       next contract traded more than the front one the session before (and at the auto close 
+    #       date at the latest)
+    # adjustment: 'mul' (prices before a roll are multiplied by next/front close the session before 
+    #             the roll), 'add' (shifted by next - front) or None
+    @staticmethod
+    def build(path, root_symbol, bars, auto_close_dates, roll='calendar', adjustment='mul', offset=0):
+        
+        sessions = pd.DatetimeIndex(bars['close'].index)
+        days = sessions.values.astype('datetime64[D]').astype(np.int64)
+        auto_close = pd.to_datetime(auto_close_dates).values.astype('datetime64[D]').astype(np.int64)
+        raw = dict((field, np.asarray(bars[field], dtype=float)) for field in CONTINUOUS_FUTURES_FIELDS)
+        contracts = np.asarray(bars['close'].columns, dtype=np.int64)
+        last = len(contracts) - 1
+        
+        # Active contract of every session (the front contract, then offset contracts further out)
+        front = 0
+        active = np.empty(len(days), dtype=np.intp)
+        for t in range(len(days)):
+            while front < last and (days[t] >= auto_close[front] or 
+                                    (roll == 'volume' and t > 0 and raw['volume'][t - 1, front + 1] > raw['volume'][t - 1, front])):
+                front += 1
+            active[t] = min(front + offset, last)
+        
+        # Cumulative adjustment of every session for the rolls after it: the adjusted series seen on 
+        # session t is stored[:t + 1] / scale[t] ('mul') or stored[:t + 1] - scale[t] ('add')
+        rolls = np.flatnonzero(active[1:] != active[:-1]) + 1
+        step = np.zeros(len(days)) if adjustment == 'add' else np.ones(len(days))
+        if adjustment in ('mul', 'add') and len(rolls):
+            before, after = raw['close'][rolls - 1, active[rolls - 1]], raw['close'][rolls - 1, active[rolls]]
+            change = after / before if adjustment == 'mul' else after - before
+            step[rolls - 1] = np.where(np.isfinite(change), change, step[rolls - 1])
+        scale = np.cumsum(step[::-1])[::-1] if adjustment == 'add' else np.cumprod(step[::-1])[::-1]
+        
+        key = ContinuousFutureStore.key(root_symbol, roll, adjustment, offset)
+        rows = np.arange(len(days))
+        np.save('%s/%s.sessions.npy' % (path, key), days)
+        np.save('%s/%s.contract.npy' % (path, key), contracts[active])
+        np.save('%s/%s.scale.npy' % (path, key), scale)
+        for field in CONTINUOUS_FUTURES_FIELDS:
+            values = raw[field][rows, active]
+            if field != 'volume':
+                values = values + scale if adjustment == 'add' else values * scale
+            np.save('%s/%s.%s.npy' % (path, key, field), values)
+    
+    # Position of session day (a date) in the series, which must cover it
+    def _locate(self, series, day):
+        day = np.datetime64(pd.Timestamp(day).date(), 'D').astype(np.int64)
+        t = np.searchsorted(series['sessions'], day)
+        if t == len(series['sessions']) or series['sessions'][t] != day:
+            raise KeyError('%s is not a session of the continuous futures store' % pd.Timestamp(day, unit='D').date())
+        return t
+    
+    # The bars sessions before day of field, adjusted as seen on day (OHLC and price are rescaled, 
+    # volume is not)
+    def history(self, future, field, day, bars):
+        series = self._series(future)
+        t = self._locate(series, day)
+        window = series[field][max(t - bars, 0):t]
+        if field == 'volume' or future.adjustment not in ('mul', 'add'):
+            return window
+        return window / series['scale'][t] if future.adjustment == 'mul' else window - series['scale'][t]
+    
+    # Sessions of the same window as history
+    def sessions(self, future, day, bars):
+        series = self._series(future)
+        t = self._locate(series, day)
+        return pd.DatetimeIndex(np.asarray(series['sessions'][max(t - bars, 0):t]).astype('datetime64[D]'), tz='UTC')
+    
+    # sid of the contract future trades on day
+    def contract(self, future, day):
+        series = self._series(future)
+        return series['contract'][self._locate(series, day)]
+
+CONTINUOUS_FUTURES_STORE = ContinuousFutureStore(CONTINUOUS_FUTURES_STORE_PATH) if CONTINUOUS_FUTURES_STORE_PATH else None
+
+
+# Same as data.history(futures, fields, bars, '1d'), read from the store when there is one: the 
+# completed sessions come from the store and today's bar from data.current. A list of fields 
+# returns a dict of DataFrames (indexed like the Panel data.history returns: [field][future])
+def future_history(data, futures, fields, bars):
+    
+    if CONTINUOUS_FUTURES_STORE is None:
+        return data.history(futures, fields, bars, '1d')
+    
+    today = get_datetime().normalize()
+    frames = {}
+    for field in ([fields] if isinstance(fields, str) else fields):
+        block = np.column_stack([CONTINUOUS_FUTURES_STORE.history(future, field, today, bars - 1) for future in futures])
+        current = np.asarray(data.current(futures, field), dtype=float)
+        index = CONTINUOUS_FUTURES_STORE.sessions(futures[0], today, bars - 1).append(pd.DatetimeIndex([today]))
+        frames[field] = pd.DataFrame(np.vstack([block, current]), index=index, columns=futures)
+    return frames[fields] if isinstance(fields, str) else frames
+
+
+# Same as data.current(futures, 'contract'), from the store's contract calendar when there is one
+def future_contracts(data, futures):
+    
+    if CONTINUOUS_FUTURES_STORE is None:
+        return data.current(futures, 'contract')
+    
+    today = get_datetime().normalize()
+    return pd.Series([sid(CONTINUOUS_FUTURES_STORE.contract(future, today)) for future in futures], index=futures)
+
+# Pair state and weight book
+#---------------------------
+# Everything the strategy remembers about its pairs, in arrays indexed by pair id: the position in the
+# spread (1 long, -1 short, 0 flat), the hedge ratio it was entered at and the weight of each of its two
+# legs. Every root symbol gets a fixed slot, and the contract it currently trades sits in that slot, so a
+# roll only swaps the contract in place. The target weights are a series over the slots' contracts that
+# is a view of the book's weight array, built once and re-indexed only when a contract rolls.
+class PairBook(object):
+    
+    def __init__(self, pairs):
+        self.futures = []       # continuous future of every slot
+        self.slots = {}         # root symbol -> slot
+        for future in itertools.chain.from_iterable(pairs):
+            if future.root_symbol not in self.slots:
+                self.slots[future.root_symbol] = len(self.futures)
+                self.futures.append(future)
+        self.legs = np.array([[self.slots[future_y.root_symbol], self.slots[future_x.root_symbol]] 
+                              for future_y, future_x in pairs], dtype=np.intp).reshape(-1, 2)
+        self.position = np.zeros(len(self.legs), dtype=np.int8)
+        self.hedge_ratio = np.full(len(self.legs), np.nan)
+        self.leg_weights = np.zeros((len(self.legs), 2))
+        self.contracts = [None] * len(self.futures)
+        self.weights = np.zeros(len(self.futures))
+        self.targets = pd.Series(self.weights, index=self.contracts, copy=False)
+    
+    # Put the current contract of every slot in place (contracts are in slot order)
+    def roll(self, contracts):
+        rolled = False
+        for slot, contract in enumerate(contracts):
+            if contract != self.contracts[slot]:
+                self.contracts[slot] = contract
+                rolled = True
+        if rolled:
+            self.targets.index = self.contracts
+        return rolled
+    
+    # Sum the leg weights of all pairs into their slots, scaled by the number of pairs
+    def update_targets(self):
+        self.weights[:] = 0
+        np.add.at(self.weights, self.legs, self.leg_weights)
+        self.weights /= max(len(self.legs), 1)
+        return self.targets
+
+# Batched Engle-Granger cointegration test
+#-----------------------------------------
+# The same test as statsmodels coint(y, x): regress y on x with a constant, then run an ADF test (no 
+# constant) on the residuals with the lag length picked by AIC, and look up the MacKinnon p-value.
+# Here y and x are (days x pairs) arrays, and every regression is solved for all pairs at once as a 
+# stack of small least-squares problems, so the cost barely grows with the number of pairs. The slope 
+# of the cointegrating regression is returned as well -- it is the hedge ratio, so it is never refit.
+
+# MacKinnon (2010) p-value surface for the Engle-Granger t statistic with a constant and 2 variables
+# (the coefficients statsmodels' mackinnonp uses for regression='c', N=2)
+MACKINNON_TAU_MAX = 0.92
+MACKINNON_TAU_MIN = -18.86
+MACKINNON_TAU_STAR = -2.62
+MACKINNON_SMALL_P = [2.92, 1.5012, 0.039796]
+MACKINNON_LARGE_P = [2.1945, 0.64695, -0.29198, -0.042377]
+
+def mackinnon_pvalue(tstat):
+    tstat = np.asarray(tstat, dtype=float)
+    small = np.polyval(MACKINNON_SMALL_P[::-1], tstat)
+    large = np.polyval(MACKINNON_LARGE_P[::-1], tstat)
+    pvalue = sp.stats.norm.cdf(np.where(tstat <= MACKINNON_TAU_STAR, small, large))
+    return np.where(tstat > MACKINNON_TAU_MAX, 1.0, np.where(tstat < MACKINNON_TAU_MIN, 0.0, pvalue))
+
+# Least squares for a stack of problems: design is (pairs x obs x regressors), target is (pairs x obs)
+def stacked_ols(design, target):
+    xtx = np.einsum('pok,poj->pkj', design, design)
+    inverse = np.linalg.inv(xtx)
+    coef = np.einsum('pkj,pj->pk', inverse, np.einsum('pok,po->pk', design, target))
+    ssr = ((target - np.einsum('pok,pk->po', design, coef)) ** 2).sum(axis=1)
+    return coef, ssr, inverse
+
+# Returns (t statistics, p-values, hedge ratios), one per pair (column); NaN for pairs with missing prices
+def coint_batch(y, x, maxlag=None):
+    
+    y = np.asarray(y, dtype=float).T
+    x = np.asarray(x, dtype=float).T
+    pairs, nobs = y.shape
+    tstat, slope = np.full(pairs, np.nan), np.full(pairs, np.nan)
+    valid = np.flatnonzero(np.isfinite(y).all(axis=1) & np.isfinite(x).all(axis=1))
+    if len(valid) == 0:
+        return tstat, mackinnon_pvalue(tstat), slope
+    
+    # First stage: y = intercept + slope * x
+    y_dev = y[valid] - y[valid].mean(axis=1)[:, None]
+    x_dev = x[valid] - x[valid].mean(axis=1)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope[valid] = (x_dev * y_dev).sum(axis=1) / (x_dev * x_dev).sum(axis=1)
+        resid = y_dev - slope[valid][:, None] * x_dev
+        rsquared = 1 - (resid ** 2).sum(axis=1) / (y_dev ** 2).sum(axis=1)
+    
+    # Pairs without a usable residual are settled before the ADF regressions, whose normal equations 
+    # would be singular for them: (almost) perfectly collinear legs, a flat Y included, get -inf like 
+    # in statsmodels, and a flat X (no hedge ratio) gets NaN like missing prices
+    flat = ~np.isfinite(slope[valid])
+    collinear = ~flat & ~(rsquared < 1 - 100 * np.sqrt(np.finfo(float).eps))
+    tstat[valid[collinear]] = -np.inf
+    valid, resid = valid[~flat & ~collinear], resid[~flat & ~collinear]
+    if len(valid) == 0:
+        return tstat, mackinnon_pvalue(tstat), slope
+    
+    # ADF regressions on the residuals: the lagged level and `lags` lagged differences, fit on the last 
+    # `rows` differences
+    if maxlag is None:
+        maxlag = min(nobs // 2 - 1, int(np.ceil(12.0 * np.power(nobs / 100.0, 1 / 4.0))))
+    diff = np.diff(resid, axis=1)
+    ndiff = diff.shape[1]
+    
+    def regression(members, lags, rows):
+        columns = [resid[members, -rows - 1:-1]] + [diff[members, ndiff - rows - l:ndiff - l] for l in range(1, lags + 1)]
+        return stacked_ols(np.stack(columns, axis=2), diff[members, -rows:])
+    
+    # Pick the lag length with the smallest AIC (all lengths on the same sample, ties go to fewer lags)
+    rows = ndiff - maxlag
+    everyone = np.arange(len(valid))
+    aic = np.array([rows * (np.log(2 * np.pi) + np.log(regression(everyone, lags, rows)[1] / rows) + 1) + 2 * (lags + 1) 
+                    for lags in range(maxlag + 1)])
+    best = aic.argmin(axis=0)
+    
+    # Refit with the chosen lag length on all the rows it allows and take the t statistic of the level
+    stat = np.empty(len(valid))
+    for lags in np.unique(best):
+        members = np.flatnonzero(best == lags)
+        rows = ndiff - lags
+        coef, ssr, inverse = regression(members, lags, rows)
+        stat[members] = coef[:, 0] / np.sqrt(ssr / (rows - lags - 1) * inverse[:, 0, 0])
+    
+    tstat[valid] = stat
+    return tstat, mackinnon_pvalue(tstat), slope
+
+# Streaming Kalman filter hedge ratios
+#-------------------------------------
+# Alternative to refitting the regression every day. Each pair keeps a Kalman filter on 
+# log(Y) = intercept + slope * log(X), with coefficients that follow a random walk, plus exponentially 
+# weighted short/long means and the variance of the spread Y - slope * X. A new bar updates all of it 
+# in O(1) per pair, so the zscore can be refreshed on any bar (minute bars included) without pulling 
+# history again. History is only read to seed a pair: at the start and whenever one of its legs rolls 
+# to a new contract. A freshly seeded pair gives exactly the 'ols' hedge ratio and zscore.
+class KalmanHedge(object):
+    
+    def __init__(self, count, short_ma, long_ma, delta=1e-4):
+        # delta sets how fast the coefficients may drift (0 = fixed coefficients, i.e. recursive least squares)
+        self.transition_var = delta / (1 - delta)
+        self.short_alpha = 2.0 / (short_ma + 1)
+        self.long_alpha = 2.0 / (long_ma + 1)
+        self.short_ma = short_ma
+        self.coef = np.full((count, 2), np.nan)       # (slope, intercept) of log(Y) on log(X)
+        self.cov = np.zeros((count, 2, 2))
+        self.observation_var = np.full(count, np.nan)
+        self.short_mean = np.full(count, np.nan)
+        self.long_mean = np.full(count, np.nan)
+        self.spread_var = np.full(count, np.nan)
+        self.contracts = [None] * count
+    
+    # Start pair i from a regression on a window of prices of the current contracts
+    def seed(self, i, Y, X, contracts):
+        design = np.column_stack([np.log(X), np.ones(len(X))])
+        inverse = np.linalg.inv(design.T.dot(design))
+        self.coef[i] = inverse.dot(design.T.dot(np.log(Y)))
+        self.observation_var[i] = ((np.log(Y) - design.dot(self.coef[i])) ** 2).sum() / (len(Y) - 2)
+        self.cov[i] = self.observation_var[i] * inverse
+        spreads = Y - self.coef[i, 0] * X
+        self.short_mean[i] = np.mean(spreads[-self.short_ma:])
+        self.long_mean[i] = np.mean(spreads)
+        self.spread_var[i] = np.var(spreads, ddof=1)
+        self.contracts[i] = contracts
+    
+    # One bar for the pairs in idx, Y and X are their current prices
+    def update(self, idx, Y, X):
+        h = np.column_stack([np.log(X), np.ones(len(idx))])
+        prior = self.cov[idx] + self.transition_var * np.eye(2)
+        prior_h = np.einsum('nij,nj->ni', prior, h)
+        gain = prior_h / ((h * prior_h).sum(axis=1) + self.observation_var[idx])[:, None]
+        self.coef[idx] += gain * (np.log(Y) - (h * self.coef[idx]).sum(axis=1))[:, None]
+        self.cov[idx] = prior - gain[:, :, None] * prior_h[:, None, :]
+        
+        spreads = Y - self.coef[idx, 0] * X
+        self.short_mean[idx] += self.short_alpha * (spreads - self.short_mean[idx])
+        deviation = spreads - self.long_mean[idx]
+        self.long_mean[idx] += self.long_alpha * deviation
+        self.spread_var[idx] = (1 - self.long_alpha) * (self.spread_var[idx] + self.long_alpha * deviation ** 2)
+        return self.signals(idx)
+    
+    # (hedge ratios, zscores) of the pairs in idx
+    def signals(self, idx):
+        return self.coef[idx, 0], (self.short_mean[idx] - self.long_mean[idx]) / np.sqrt(self.spread_var[idx])
+
 #-------------------------------------------------------------------------------------------------    
 # Function to compute the respective holdings percentages by taking the sum of the absolute value of 
 # both dollar amounts (notionalDol) and dividing each of X and Y's dollar amounts by this, such that 
@@ -11,6 +11,10 @@ from quantopian.pipeline import CustomFactor
 # IMPORT TWO PIPELINE FUNCTIONS NECESSARY FOR ALGORITHM
 from quantopian.algorithm import attach_pipeline, pipeline_output    
 
+# IMPORT BATCH ORDERING (OPTIMIZE API)
+from quantopian.algorithm import order_optimal_portfolio
+import quantopian.optimize as opt
+
 # IMPORT DATASETS  
 from quantopian.pipeline.data.builtin import USEquityPricing  
 from quantopian.pipeline.data import morningstar
@@ -30,16 +34,179 @@ returns are sold short. The portfolio is set up to be dollar neutral and rebalan
 once a month. 
 """
                 
-# INITIALIZE ALGORITHM                      
-#-----------------------                   
-def initialize(context):
+# PIPELINE PRECOMPUTATION (OFFLINE BACKTESTS)
+#---------------------------------------------
+# IN AN OFFLINE ZIPLINE BACKTEST, precompute_pipeline SPLITS THE SESSIONS INTO CHUNKS, RUNS EVERY 
+# CHUNK ON A PROCESS POOL AND STITCHES THE RESULTS. STORED IN PRECOMPUTED_PIPELINES (BY PIPELINE NAME) 
+# BEFORE THE BACKTEST STARTS, THAT PIPELINE IS NOT ATTACHED AND ITS DAILY OUTPUT BECOMES A LOOKUP. 
+# EACH CHUNK STARTS PIPELINE_LOOKBACK SESSIONS EARLY SO THAT FACTORS THAT KEEP STATE ACROSS DAYS 
+# (RUNNING SUMS, INCREMENTAL RANKS) ARE WARM; THOSE OVERLAP ROWS ARE DROPPED WHEN STITCHING.
+# run_chunk(start, end) MUST RETURN THE run_pipeline FRAME FOR make_pipeline() OVER [start, end], 
+# e.g. lambda start, end: engine.run_pipeline(make_pipeline(), start, end). WORKERS ARE FORKED, SO IT 
+# DOES NOT NEED TO BE PICKLABLE, BUT THIS FILE MUST BE IMPORTED AS A MODULE (e.g. imp.load_source).
+# THE QUANTOPIAN IDE HAS NO PROCESS POOLS, SO THERE PRECOMPUTED_PIPELINES STAYS EMPTY.
+# THE OUTPUT IS ONLY READ ON THE DAYS THE SCHEDULED FUNCTIONS RUN, SO WITH days (e.g. 
+# scheduled_sessions(sessions, 'month_start')) ONLY THOSE SESSIONS ARE EVALUATED, EACH WARMED UP overlap
+# SESSIONS EARLY; WARM-UPS THAT OVERLAP ARE MERGED INTO ONE JOB (UP TO chunk_size SESSIONS).
+# THIS PIPELINE KEEPS NO STATE, SO WITH days overlap DEFAULTS TO 0 AND EVERY month_start SESSION IS 
+# ITS OWN ONE-DAY JOB (WARM-UPS OF PIPELINE_LOOKBACK SESSIONS WOULD MERGE INTO NEARLY EVERY SESSION)
+PIPELINE_LOOKBACK = 21
+PRECOMPUTED_PIPELINES = {}
+_CHUNK_RUNNER = None
+
+def precompute_pipeline(run_chunk, sessions, chunk_size=252, overlap=None, processes=None, days=None):
+    
+    import multiprocessing
+    global _CHUNK_RUNNER
+    _CHUNK_RUNNER = run_chunk
+    
+    sessions = pd.DatetimeIndex(sessions)
+    if overlap is None:
+        overlap = PIPELINE_LOOKBACK if days is None else 0
+    if days is None:
+        starts = range(0, len(sessions), chunk_size)
+        jobs = [(max(start - overlap, 0), start, min(start + chunk_size, len(sessions)) - 1) for start in starts]
+    else:
+        days = pd.DatetimeIndex(days)
+        jobs = []
+        for day in sessions.searchsorted(days):
+            if jobs and day - overlap <= jobs[-1][2] + 1 and day - jobs[-1][1] < chunk_size:
+                jobs[-1][2] = day
+            else:
+                jobs.append([max(day - overlap, 0), day, day])
+    jobs = [(sessions[warm_start], sessions[start], sessions[end]) for warm_start, start, end in jobs]
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        frames = pool.map(_run_chunk, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    frame = pd.concat(frames)
+    if days is not None:
+        frame = frame[frame.index.get_level_values(0).isin(days)]
+    return frame
+
+# SESSIONS ON WHICH A date_rules.month_start() OR date_rules.week_start() FUNCTION RUNS 
+# (THE FIRST SESSION OF EVERY MONTH OR WEEK)
+def scheduled_sessions(sessions, rule):
+    sessions = pd.DatetimeIndex(sessions)
+    if rule == 'month_start':
+        period = np.asarray(sessions.year * 12 + sessions.month)
+    else:
+        period = np.asarray((sessions - pd.to_timedelta(sessions.dayofweek, unit='D')).normalize())
+    return sessions[np.concatenate([[True], period[1:] != period[:-1]])]
+
+def _run_chunk(job):
+    warm_start, start, end = job
+    frame = _CHUNK_RUNNER(warm_start, end)
+    return frame[frame.index.get_level_values(0) >= start]
+
+# ATTACH A PIPELINE UNLESS ITS OUTPUT WAS PRECOMPUTED
+def attach(pipe, name):
+    if name not in PRECOMPUTED_PIPELINES:
+        attach_pipeline(pipe, name)
+
+# TODAY'S OUTPUT OF A PIPELINE (A LOOKUP WHEN IT WAS PRECOMPUTED)
+def load_pipeline_output(name):
+    if name not in PRECOMPUTED_PIPELINES:
+        return pipeline_output(name)
+    return PRECOMPUTED_PIPELINES[name].xs(get_datetime().normalize(), level=0)
+
+
+# TRADING COST SETTINGS (USED BY initialize AND BY THE OFFLINE FillEngine)
+SLIPPAGE_BASIS_POINTS = 5
+VOLUME_LIMIT = 0.1
+COMMISSION_PER_SHARE = 0.005
+MIN_TRADE_COST = 1
+
+
+# OFFLINE FILL SIMULATION
+#-------------------------
+# FILLS ALL OPEN ORDERS AGAINST ONE BAR AT ONCE WITH THE SAME RULES AS FixedBasisPointsSlippage AND 
+# PerShare: EVERY ASSET FILLS AT MOST int(volume_limit * BAR VOLUME) SHARES PER BAR, SHARED BY ITS 
+# ORDERS IN SUBMISSION ORDER, AT close * (1 +- basis_points / 10000). AN ORDER PAYS cost_per_share ON 
+# EVERY SHARE BUT AT LEAST min_trade_cost IN TOTAL (CHARGED WITH ITS FIRST FILL). WHAT DOES NOT FILL 
+# STAYS OPEN FOR THE NEXT BAR; cancel() DROPS EVERYTHING (e.g. AT THE END OF THE DAY). ASSETS ARE SIDS.
+class FillEngine(object):
+    
+    def __init__(self, basis_points=SLIPPAGE_BASIS_POINTS, volume_limit=VOLUME_LIMIT, 
+                 cost_per_share=COMMISSION_PER_SHARE, min_trade_cost=MIN_TRADE_COST):
+        self.basis_points = basis_points
+        self.volume_limit = volume_limit
+        self.cost_per_share = cost_per_share
+        self.min_trade_cost = min_trade_cost
+        self.cancel()
+    
+    # DROP ALL OPEN ORDERS
+    def cancel(self):
+        self.sids = np.zeros(0, dtype=np.int64)
+        self.open = np.zeros(0, dtype=np.int64)
+        self.filled = np.zeros(0, dtype=np.int64)
+        self.commission = np.zeros(0)
+    
+    # QUEUE ORDERS (SIGNED SHARE AMOUNTS, TRUNCATED TO WHOLE SHARES)
+    def order(self, sids, amounts):
+        amounts = np.asarray(amounts, dtype=float).astype(np.int64)
+        sids = np.asarray(sids, dtype=np.int64)[amounts != 0]
+        amounts = amounts[amounts != 0]
+        self.sids = np.concatenate([self.sids, sids])
+        self.open = np.concatenate([self.open, amounts])
+        self.filled = np.concatenate([self.filled, np.zeros(len(amounts), dtype=np.int64)])
+        self.commission = np.concatenate([self.commission, np.zeros(len(amounts))])
+    
+    # FILL THE OPEN ORDERS AGAINST ONE BAR (sids SORTED) AND RETURN THE TRANSACTIONS AS ARRAYS
+    # (sids, amounts, prices, commissions), ONE ROW PER ORDER THAT TRADED
+    def fill(self, sids, close, volume):
+        
+        n = len(self.open)
+        sids = np.asarray(sids, dtype=np.int64)
+        pos = np.searchsorted(sids, self.sids).clip(0, max(len(sids) - 1, 0))
+        listed = sids[pos] == self.sids if len(sids) else np.zeros(n, dtype=bool)
+        price = np.where(listed, np.asarray(close, dtype=float)[pos] if len(sids) else np.nan, np.nan)
+        bar_volume = np.where(listed & ~np.isnan(price), np.asarray(volume, dtype=float)[pos] if len(sids) else 0, 0)
+        
+        # EACH ASSET'S VOLUME LIMIT IS USED UP BY ITS ORDERS IN SUBMISSION ORDER
+        order = np.lexsort((np.arange(n), self.sids))
+        wanted = np.abs(self.open[order])
+        capacity = np.floor(self.volume_limit * bar_volume[order]).astype(np.int64)
+        asset = self.sids[order]
+        new_asset = np.concatenate([[True], asset[1:] != asset[:-1]]) if n else np.zeros(0, dtype=bool)
+        before = np.cumsum(wanted) - wanted
+        before -= before[np.flatnonzero(new_asset)][np.cumsum(new_asset) - 1]
+        shares = np.empty(n, dtype=np.int64)
+        shares[order] = np.clip(capacity - before, 0, wanted)
+        
+        # SLIPPAGE AND COMMISSION (MINIMUM COST ON THE FIRST FILL, THEN ONLY ONCE THE SHARES EXCEED IT)
+        direction = np.sign(self.open)
+        prices = price * (1 + direction * self.basis_points / 10000.0)
+        filled = self.filled + shares
+        per_share = filled * self.cost_per_share
+        commission = np.where(self.commission == 0, np.maximum(self.min_trade_cost, shares * self.cost_per_share), 
+                              np.where(per_share < self.min_trade_cost, 0.0, per_share - self.commission))
+        commission = np.where(shares > 0, commission, 0.0)
+        
+        traded = np.flatnonzero(shares > 0)
+        transactions = (self.sids[traded], (direction * shares)[traded], prices[traded], commission[traded])
+        
+        # UNFILLED REMAINDERS CARRY OVER TO THE NEXT BAR
+        self.open = self.open - direction * shares
+        self.filled = filled
+        self.commission = self.commission + commission
+        keep = self.open != 0
+        self.sids, self.open, self.filled, self.commission = (self.sids[keep], self.open[keep], 
+                                                              self.filled[keep], self.commission[keep])
+        return transactions
+
+
+# BUILD PIPELINE                      
+#----------------                   
+def make_pipeline():
     
     # UNIVERSE DECLARATION
     universe = QTradableStocksUS()
     
-    # ATTACH PIPELINE NAME
     pipe = Pipeline(screen=universe)
-    attach_pipeline(pipe, 'my pipe')
     
     # ADD SECTOR TO THE PIPELINE
     sector = Fundamentals.morningstar_sector_code.latest
@@ -58,6 +225,15 @@ def initialize(context):
     # DEFINE OUR PRE-FILTERED LONG AND SHORT LISTS
     longs = (prod_return > 0) 
     pipe.add(longs, 'longs')    
+    return pipe
+    
+    
+# INITIALIZE ALGORITHM                      
+#-----------------------                   
+def initialize(context):
+    
+    # ATTACH PIPELINE NAME
+    attach(make_pipeline(), 'my pipe')
     
         
 # SETTINGS
@@ -76,31 +252,34 @@ def initialize(context):
                       half_days=True)
 
     
+    # BASKET SETTINGS (True PICKS THE TOP/BOTTOM 50 WITHIN EVERY SECTOR)
+    context.by_sector = False
+    
     # LEVERAGE SETTINGS (CAN BE ADJUSTED)
     context.long_leverage = 0.5
     context.short_leverage = -0.5 
     
     # SLIPPAGE SETTINGS (CAN BE ADJUSTED - DEFAULT)
-    set_slippage(us_equities=slippage.FixedBasisPointsSlippage(basis_points=5, volume_limit=0.1)) 
+    set_slippage(us_equities=slippage.FixedBasisPointsSlippage(basis_points=SLIPPAGE_BASIS_POINTS, volume_limit=VOLUME_LIMIT)) 
             
     # COMMISSION SETTINGS (CAN BE ADJUSTED - SET TO INTERACTIVE BROKERS COMMISSION PRICING)
-    set_commission(us_equities=commission.PerShare(cost=0.005, min_trade_cost=1))
+    set_commission(us_equities=commission.PerShare(cost=COMMISSION_PER_SHARE, min_trade_cost=MIN_TRADE_COST))
 
        
-# EVERYDAY BEFORE TRADING START: 
-#--------------------------------                      
-def before_trading_start(context, data):
+# LOAD THE BASKETS (ONLY ON REBALANCE DAYS, THE ONLY DAYS THE OUTPUT IS READ): 
+#-----------------------------------------------------------------------------                      
+def load_baskets(context):
     
-    # CALL PIPELINE BEFORE TRADING START
-    context.output = pipeline_output('my pipe')
+    # CALL PIPELINE
+    context.output = load_pipeline_output('my pipe')
     
-    # IF A STOCK HAS ALREADY BEEN CATEGORIZED AS A LONG, TAKE THE TOP OF THE MONTHLY RETURNS
-    for stock in context.output['longs'] == 0:     
-        context.long_list = context.output.sort_values(['Mrank'], ascending=False).iloc[:50]
-        
-    # IF A STOCK HAS ALREADY BEEN CATEGORIZED AS NOT A LONG (SHORT), TAKE THE BOTTOM OF THE MONTHLY RETURNS
-    for stock in context.output['longs'] != 0:
-        context.short_list = context.output.sort_values(['Mrank'], ascending=False).iloc[-50:]  
+    # DOUBLE SORT: THE SIGN OF THE CUMULATIVE RETURN PRE-FILTERS THE BASKETS, THEN THE TOP 50 RANKS OF
+    # THE POSITIVE ONES GO LONG AND THE BOTTOM 50 OF THE REST GO SHORT (PER SECTOR IF context.by_sector)
+    # (ROW POSITIONS IN context.output AND THE MATCHING ASSETS, HIGHEST RANK FIRST)
+    context.long_idx, context.short_idx = double_sort(context.output['longs'].values, context.output['Mrank'].values, 50, 
+                                                      groups=context.output['sector'].values if context.by_sector else None)
+    context.long_list = context.output.index[context.long_idx]
+    context.short_list = context.output.index[context.short_idx]
                 
                 
 # RECORD AND RETURN VARIABLES: RETURN THE TOP TEN RETURN RANKING STOCKS FROM THE LONG AND SHORT LISTS       
@@ -112,38 +291,88 @@ def record_vars(context, data):
         
     # PRINT TOP 10 DAILY LONG AND SHORT POSITIONS
     print "Long List"
-    log.info("\n" + str(context.long_list.sort_values(['Mrank'], ascending=True).head(10)))
+    log.info("\n" + str(context.output.iloc[context.long_idx[::-1][:10]]))
     
     print "Short List" 
-    log.info("\n" + str(context.short_list.sort_values(['Mrank'], ascending=True).head(10)))      
+    log.info("\n" + str(context.output.iloc[context.short_idx[::-1][:10]]))      
     
                
 # REBALANCE
 #-----------
 def rebalance(context,data):
     
+    # PIPELINE OUTPUT AND BASKETS FOR THIS MONTH (ALSO PRINTED BY record_vars)
+    load_baskets(context)
+    
     # DEFINE THE TARGET WEIGHT OF EACH STOCK IN THE PORTFOLIO TO BE EQUAL ACROSS BOTH LISTS
-    long_weight = context.long_leverage / float(len(context.long_list))
-    short_weight = context.short_leverage / float(len(context.short_list))
-
-    # FOR EACH STOCK THAT WE HAVE CLASSIFIED IN OUR LONG AND SHORT LISTS, 
-    # WE WANT TO PLACE A MARKET ORDER BASED ON THE DEFINED TARGET PERCENT. 
-    # THE ORDER WILL BE EXECUTED WHEN THE FUNCTION IS SCHEDULED TO BE CALLED 
-    # (SEE SETTINGS)
-     
-    for long_stock in context.long_list.index:
-        log.info("ordering longs")
-        log.info("weight is %s" % (long_weight))
-        order_target_percent(long_stock, long_weight)
-       
-        
-    for short_stock in context.short_list.index:
-        log.info("ordering shorts")
-        log.info("weight is %s" % (short_weight))
-        order_target_percent(short_stock, short_weight)
-              
-        
-    # EXIT ANY POSITIONS THAT ARE NO LONGER ON OUR LONG OR SHORT LIST    
-    for stock in context.portfolio.positions.iterkeys():
-        if stock not in context.long_list.index and stock not in context.short_list.index:
-            order_target(stock, 0)
+    # (A PRE-FILTERED BASKET CAN BE EMPTY, e.g. NO POSITIVE MONTHLY RETURNS)
+    long_weight = context.long_leverage / float(max(len(context.long_list), 1))
+    short_weight = context.short_leverage / float(max(len(context.short_list), 1))
+
+    # BUILD ONE TARGET WEIGHT VECTOR FOR BOTH LISTS (A STOCK ON BOTH LISTS KEEPS ITS SHORT WEIGHT).
+    # ANY HELD POSITION THAT IS NOT IN THE VECTOR HAS A TARGET OF 0, SO THE OPTIMIZER DIFFS THE 
+    # WEIGHTS AGAINST CURRENT HOLDINGS AND SUBMITS EVERY ORDER, INCLUDING THE EXITS, AS ONE BATCH
+    # WHEN THE FUNCTION IS SCHEDULED TO BE CALLED (SEE SETTINGS)
+    weights = pd.Series(np.concatenate([np.full(len(context.long_list), long_weight), 
+                                        np.full(len(context.short_list), short_weight)]), 
+                        index=context.long_list.append(context.short_list))
+    weights = weights[~weights.index.duplicated(keep='last')]
+    
+    log.info("ordering %s longs at weight %s and %s shorts at weight %s" % (len(context.long_list), long_weight, 
+                                                                          len(context.short_list), short_weight))
+    order_optimal_portfolio(opt.TargetWeights(weights), constraints=[])
+
+
+
+# DOUBLE SORT
+#-------------
+# ALL SORTS SHARE ONE lexsort BY (GROUP, VALUE), WHICH GIVES EVERY ROW ITS POSITION INSIDE ITS GROUP 
+# (0 = LOWEST VALUE) AND THE SIZE OF THAT GROUP, SO NO SORT LOOPS OVER GROUPS IN PYTHON. NaN VALUES 
+# ARE NEVER SELECTED OR BUCKETED.
+
+# POSITION OF EVERY ROW INSIDE ITS GROUP WHEN SORTED BY values, AND THE SIZE OF THAT GROUP 
+# (NaN VALUES FORM THEIR OWN GROUP)
+def group_positions(values, groups=None):
+    
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    valid = ~np.isnan(values)
+    keys = np.zeros(n, dtype=np.int64) if groups is None else pd.factorize(np.asarray(groups))[0].astype(np.int64)
+    keys = np.where(valid, keys, -1)
+    
+    order = np.lexsort((values, keys))
+    sorted_keys = keys[order]
+    new_group = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]) if n else np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(new_group)
+    group = np.cumsum(new_group) - 1
+    
+    position = np.empty(n, dtype=np.int64)
+    size = np.empty(n, dtype=np.int64)
+    position[order] = np.arange(n) - starts[group]
+    size[order] = np.diff(np.append(starts, n))[group]
+    return position, size, valid
+
+# TOP k OF values AMONG THE prefilter ROWS (LONGS) AND BOTTOM k AMONG THE OTHER ROWS (SHORTS), 
+# AS ROW POSITIONS ORDERED FROM HIGHEST TO LOWEST. WITH groups (e.g. SECTOR CODES) IT IS k PER GROUP.
+def double_sort(prefilter, values, k, groups=None):
+    
+    prefilter = np.asarray(prefilter, dtype=bool)
+    keys = prefilter.astype(np.int64)
+    if groups is not None:
+        keys = keys + 2 * pd.factorize(np.asarray(groups))[0]
+    position, size, valid = group_positions(values, keys)
+    
+    top = np.flatnonzero(valid & prefilter & (position >= size - k))
+    bottom = np.flatnonzero(valid & ~prefilter & (position < k))
+    
+    values = np.asarray(values, dtype=float)
+    top = top[np.argsort(-values[top], kind='mergesort')]
+    bottom = bottom[np.argsort(-values[bottom], kind='mergesort')]
+    return top, bottom
+
+# QUANTILE BUCKET OF EVERY ROW INSIDE ITS GROUP (0 = LOWEST, buckets - 1 = HIGHEST, -1 FOR NaN).
+# A QUINTILE-BY-QUINTILE (CONDITIONAL) SORT IS
+#     first = bucket_sort(a, 5);  second = bucket_sort(b, 5, groups=first);  cell = 5 * first + second
+def bucket_sort(values, buckets, groups=None):
+    position, size, valid = group_positions(values, groups)
+    return np.where(valid, position * buckets // np.maximum(size, 1), -1)
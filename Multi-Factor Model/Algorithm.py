@@ -9,6 +9,9 @@
 
 # IMPORT LIBRARIES
 #------------------
+import numpy as np
+import pandas as pd
+
 # IMPORT PIPELINE
 from quantopian.pipeline import Pipeline
 from quantopian.pipeline import CustomFactor
@@ -16,6 +19,10 @@ from quantopian.pipeline import CustomFactor
 # IMPORT TWO PIPELINE FUNCTIONS NECESSARY FOR ALGORITHM
 from quantopian.algorithm import attach_pipeline, pipeline_output    
 
+# IMPORT BATCH ORDERING (OPTIMIZE API)
+from quantopian.algorithm import order_optimal_portfolio
+import quantopian.optimize as opt
+
 # IMPORT DATASETS  
 from quantopian.pipeline.data.builtin import USEquityPricing  
 from quantopian.pipeline.data import morningstar
@@ -25,7 +32,7 @@ from quantopian.pipeline.data import Fundamentals
 
 # IMPORT FILTERS, FACTORS, AND CLASSIFIERS  
 from quantopian.pipeline.filters import QTradableStocksUS  
-from quantopian.pipeline.factors import AverageDollarVolume,SimpleMovingAverage
+from quantopian.pipeline.factors import AverageDollarVolume,SimpleMovingAverage,Returns
 
 
 
@@ -163,94 +170,348 @@ class MarketCap(CustomFactor):
     def compute(self, today, assets, out, close, shares):
         out[:] = close[-1] * shares[-1]
 
+
         
-                
-# INITIALIZE ALGORITHM                      
-#----------------------                     
-def initialize(context):
-    
-    # ATTACH PIPELINE NAME
-    pipe = Pipeline()
-    attach_pipeline(pipe, 'quality pipe')
-   
-    # UNIVERSE DECLARATION (TOP 5000 STOCKS ACCORDING TO MARKET CAP)
-    #mkt_cap = MarketCap()
-    universe = QTradableStocksUS()#mkt_cap.top(5000)
-    
-    
-    # ADD SECTOR TO THE PIPELINE
-    sector = Fundamentals.morningstar_sector_code.latest
-    pipe.add(sector, 'sector') 
+# POINT-IN-TIME FUNDAMENTALS STORE (OFFLINE BACKTESTS)
+#-----------------------------------------------------
+# FUNDAMENTALS ONLY CHANGE WHEN A FILING LANDS, SO INSTEAD OF LOOKING UP EVERY FIELD EVERY DAY,
+# FundamentalsStore.build WRITES ONE .npy ARRAY PER FIELD WITH ONE ROW PER (ASSET, FILING DATE), 
+# SORTED BY ASSET AND THEN DATE. LOADED WITH mmap_mode='r', SEVERAL BACKTEST PROCESSES SHARE 
+# THE SAME PAGES, AND "LATEST VALUE AS OF DAY D" FOR ALL ASSETS IS ONE searchsorted AND ONE GATHER.
+# THE QUANTOPIAN IDE HAS NO FILE ACCESS, SO THERE FUNDAMENTALS_STORE_PATH STAYS None AND THE 
+# FACTORS READ THE PIPELINE COLUMNS AS USUAL.
+FUNDAMENTALS_STORE_PATH = None
 
-    
-    # ADD ASSET TURNOVER FACTOR AND RANK
-    assetturn = AssetTurnover()
-    #pipe.add(assetturn, 'assetturn')
-    assetturn_rank = assetturn.rank(mask=universe)
-    #pipe.add(assetturn_rank, 'assetturn_rank')    
+class FundamentalsStore(object):
+    
+    def __init__(self, path):
+        self.path = path
+        self.sids = self._load('sids')
+        self.starts = self._load('starts')
+        self.keys = self._load('keys')
+        self.span, self.base = [int(x) for x in self._load('span')]
+        self.fields = {}
+    
+    def _load(self, name):
+        return np.load(self.path + '/' + name + '.npy', mmap_mode='r')
+    
+    # sids, dates: ONE ENTRY PER FILING (ANYTHING pd.to_datetime ACCEPTS FOR THE DATES)
+    # columns: {FIELD NAME: ONE VALUE PER FILING}
+    @staticmethod
+    def build(path, sids, dates, columns):
+        
+        sids = np.asarray(sids, dtype=np.int64)
+        days = pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64)
+        order = np.lexsort((days, sids))
+        sids, days = sids[order], days[order]
+        
+        # ONE SLOT PER ASSET; EACH ASSET'S FILINGS SIT BETWEEN starts[slot] AND starts[slot + 1]
+        unique_sids, starts, slots = np.unique(sids, return_index=True, return_inverse=True)
+        span = days.max() - days.min() + 2
+        keys = slots * span + (days - days.min() + 1)
+        
+        np.save(path + '/sids.npy', unique_sids)
+        np.save(path + '/starts.npy', starts)
+        np.save(path + '/keys.npy', keys)
+        # span.npy HOLDS THE KEY STRIDE PER ASSET AND THE DAY BEFORE THE FIRST FILING
+        np.save(path + '/span.npy', np.array([span, days.min() - 1]))
+        for field, values in columns.items():
+            np.save(path + '/' + field + '.npy', np.asarray(values, dtype=float)[order])
+    
+    # LATEST VALUE OF EACH FIELD FILED BEFORE today FOR EVERY ASSET (NaN IF NONE), RETURNED AS 
+    # A (FIELDS x ASSETS) BLOCK. A FILING DATED today IS NOT KNOWN YET, SAME AS THE PIPELINE'S 
+    # column[-1], WHICH ONLY SEES DATA FROM BEFORE THE SESSION
+    def asof(self, fields, today, assets):
+        
+        sids = np.asarray(assets, dtype=np.int64)
+        day = pd.to_datetime([today]).values.astype('datetime64[D]').astype(np.int64)[0] - self.base
+        
+        slot = np.searchsorted(self.sids, sids).clip(0, len(self.sids) - 1)
+        known = self.sids[slot] == sids
+        pos = np.searchsorted(self.keys, slot * self.span + min(max(day, 0), self.span), side='left') - 1
+        found = known & (day > 0) & (pos >= self.starts[slot])
+        pos = np.where(found, pos, 0)
+        
+        block = np.full((len(fields), len(sids)), np.nan)
+        for i, field in enumerate(fields):
+            if field not in self.fields:
+                self.fields[field] = self._load(field)
+            block[i] = np.where(found, self.fields[field][pos], np.nan)
+        return block
 
+FUNDAMENTALS_STORE = FundamentalsStore(FUNDAMENTALS_STORE_PATH) if FUNDAMENTALS_STORE_PATH else None
+
+        
+# FUSED QUALITY FACTORS (FACTORS 1-10 AND THEIR RANKS IN ONE PASS)
+#------------------------------------------------------------------
+# THE ORDER OF THE TEN QUALITY FACTORS (ROWS OF THE FUSED BLOCK)
+QUALITY_FACTORS = ['assetturn', 'roe', 'capex', 'debt', 'profit', 
+                   'solv', 'growth', 'value', 'liquidity', 'momentum']
+
+
+# INCREMENTAL CROSS-SECTIONAL RANKS
+#-----------------------------------
+# MOST INPUTS ARE FUNDAMENTALS THAT ONLY CHANGE WHEN A FILING LANDS, SO INSTEAD OF SORTING
+# EVERY DAY WE KEEP YESTERDAY'S SORTED ORDER AND ONLY RE-POSITION THE ASSETS WHOSE VALUE 
+# CHANGED OR THAT ENTERED/LEFT THE UNIVERSE. IF MORE THAN max_changed (FRACTION) OF THE 
+# ASSETS MOVED, A FULL SORT IS CHEAPER AND IS USED INSTEAD. RANKS ARE ORDINAL (TIES ARE 
+# BROKEN BY SID, SAME AS factor.rank()) AND NaN VALUES ARE LEFT UNRANKED.
+class IncrementalRanker(object):
+    
+    def __init__(self, max_changed=0.05):
+        self.max_changed = max_changed
+        self.last_sids = None
+        self.last_values = None
+        self.sorted_sids = None
+        self.sorted_values = None
+        
+    # PIPELINE ASSETS ARRIVE SORTED BY SID, WHICH LETS US ALIGN DAYS WITH searchsorted
+    def rank(self, sids, values):
+        
+        sids = np.asarray(sids, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+        
+        if self.last_sids is None or len(self.last_sids) == 0 or len(sids) == 0:
+            self._full_sort(sids, values, missing)
+        else:
+            self._update(sids, values, missing)
+        
+        self.last_sids = sids
+        self.last_values = values.copy()
+        
+        ranks = np.full(len(sids), np.nan)
+        ranks[np.searchsorted(sids, self.sorted_sids)] = np.arange(1, len(self.sorted_sids) + 1)
+        return ranks
+    
+    def _full_sort(self, sids, values, missing):
+        order = np.lexsort((sids[~missing], values[~missing]))
+        self.sorted_sids = sids[~missing][order]
+        self.sorted_values = values[~missing][order]
+        
+    def _update(self, sids, values, missing):
+        
+        # YESTERDAY'S VALUE FOR EVERY ASSET IN TODAY'S CROSS SECTION (NaN IF IT IS NEW)
+        idx = np.searchsorted(self.last_sids, sids).clip(0, len(self.last_sids) - 1)
+        known = self.last_sids[idx] == sids
+        previous = np.where(known, self.last_values[idx], np.nan)
+        changed = ~known | ((previous != values) & ~(np.isnan(previous) & missing))
+        
+        # SORTED ENTRIES THAT LEFT THE UNIVERSE OR WHOSE VALUE CHANGED ARE TAKEN OUT
+        pos = np.searchsorted(sids, self.sorted_sids).clip(0, len(sids) - 1)
+        stale = (sids[pos] != self.sorted_sids) | changed[pos]
+        
+        if stale.sum() + changed.sum() > self.max_changed * len(sids):
+            self._full_sort(sids, values, missing)
+            return
+        
+        kept_sids = self.sorted_sids[~stale]
+        kept_values = self.sorted_values[~stale]
+        
+        # SORT ONLY THE CHANGED ASSETS AND FIND WHERE THEY SLOT INTO THE KEPT ORDER
+        new = changed & ~missing
+        order = np.lexsort((sids[new], values[new]))
+        new_sids = sids[new][order]
+        new_values = values[new][order]
+        lo = np.searchsorted(kept_values, new_values, side='left')
+        hi = np.searchsorted(kept_values, new_values, side='right')
+        
+        # EQUAL VALUES ARE ORDERED BY SID
+        for i in np.flatnonzero(hi > lo):
+            lo[i] += np.searchsorted(kept_sids[lo[i]:hi[i]], new_sids[i])
+        
+        self.sorted_sids = np.insert(kept_sids, lo, new_sids)
+        self.sorted_values = np.insert(kept_values, lo, new_values)
+
+
+# RANK ANY WINDOW SAFE FACTOR INCREMENTALLY, e.g. IncrementalRank(inputs=[quality_score], mask=universe)
+class IncrementalRank(CustomFactor):
     
-    # ADD EQUITY RETURN FACTOR AND RANK
-    roe = EquityReturn()
-    #pipe.add(roe, 'roe')
-    roe_rank = roe.rank(mask=universe)
-    #pipe.add(roe_rank, 'roe_rank') 
-    
-    
-    # ADD CAPEX FACTOR AND RANK
-    capex = CapexSales()
-    #pipe.add(capex, 'capex')
-    capex_rank = capex.rank(mask=universe)
-    #pipe.add(capex_rank, 'capex_rank') 
-    
+    window_length=1
     
-    # ADD DEBT FACTOR AND RANK
-    debt = DebtFactor()
-    #pipe.add(debt, 'debt')
-    debt_rank = debt.rank(mask=universe)
-    #pipe.add(debt_rank, 'debt_rank') 
+    def compute(self, today, assets, out, values):
+        if not hasattr(self, 'ranker'):
+            self.ranker = IncrementalRanker()
+        out[:] = self.ranker.rank(assets, values[-1])
+
 
-  
-    # ADD PROFIT FACTOR AND RANK
-    profit = ProfitFactor()
-    #pipe.add(profit, 'profit')
-    profit_rank = profit.rank(mask=universe)
-    #pipe.add(profit_rank, 'profit_rank') 
+# FUNDAMENTAL COLUMNS READ BY THE QUALITY FACTORS (FROM THE PIPELINE OR FROM THE STORE)
+QUALITY_FUNDAMENTALS = [Fundamentals.assets_turnover, 
+                        Fundamentals.roe, 
+                        Fundamentals.capital_expenditure, 
+                        Fundamentals.total_revenue, 
+                        Fundamentals.total_debt, 
+                        Fundamentals.enterprise_value, 
+                        Fundamentals.net_margin, 
+                        Fundamentals.interest_coverage, 
+                        Fundamentals.growth_score, 
+                        Fundamentals.value_score, 
+                        morningstar.valuation.shares_outstanding]
+
+
+class QualityFactors(CustomFactor):
+    
+    # EVERY COLUMN USED BY FACTORS 1-10 IS READ ONCE (MOMENTUM IS 1 + THE 60 DAY RETURN, 
+    # WHICH KEEPS THE WINDOW LENGTH AT 1 INSTEAD OF LOADING 60 DAYS OF EVERY FUNDAMENTAL).
+    # WITH A FUNDAMENTALS STORE ONLY THE PRICING COLUMNS ARE LOADED BY THE PIPELINE
+    inputs = [USEquityPricing.volume, Returns(window_length=60)]
+    if FUNDAMENTALS_STORE is None:
+        inputs = QUALITY_FUNDAMENTALS + inputs
+    window_length=1
     
+    # ONE OUTPUT PER RAW FACTOR AND ONE PER RANK (e.g. 'roe' AND 'roe_rank')
+    outputs = QUALITY_FACTORS + [name + '_rank' for name in QUALITY_FACTORS]
     
-    # ADD SOLVENCY FACTOR AND RANK
-    solv = SolvencyFactor()
-    #pipe.add(solv, 'solv')
-    solv_rank = solv.rank(mask=universe)
-    #pipe.add(solv_rank, 'solv_rank') 
+    # RANKS AND RATIOS OF LATEST VALUES ARE COMPARABLE ACROSS DAYS, SO THE OUTPUTS
+    # CAN FEED OTHER FACTORS (e.g. THE INCREMENTAL QUALITY RANK)
+    window_safe = True
     
+    # STACK THE COLUMNS INTO ONE BLOCK, DERIVE THE TEN FACTORS AND RANK EACH ONE INCREMENTALLY.
+    # WHEN CONSTRUCTED WITH mask=universe, compute ONLY RECEIVES UNIVERSE ASSETS, SO THE 
+    # RANKS MATCH factor.rank(mask=universe)
+    def compute(self, today, assets, out, *columns):
         
-    # ADD GROWTH FACTOR AND RANK
-    growth = GrowthFactor()
-    #pipe.add(growth, 'growth')
-    growth_rank = growth.rank(mask=universe)
-    #pipe.add(growth_rank, 'growth_rank') 
-    
+        if FUNDAMENTALS_STORE is None:
+            fundamentals = np.vstack([column[-1] for column in columns[:-2]])
+        else:
+            fundamentals = FUNDAMENTALS_STORE.asof([column.name for column in QUALITY_FUNDAMENTALS], today, assets)
+        
+        (assetturn, roe, capex, rev, debt, ev, margin, 
+         coverage, growth, value, shares) = fundamentals
+        volume, returns = columns[-2][-1], columns[-1][-1]
+        
+        raw = np.vstack([assetturn, 
+                         roe, 
+                         capex / rev, 
+                         debt / ev, 
+                         margin, 
+                         coverage, 
+                         growth, 
+                         value, 
+                         volume / shares, 
+                         returns + 1])
+        
+        # ONE RANKER PER FACTOR KEEPS ITS SORTED ORDER FROM ONE DAY TO THE NEXT
+        if not hasattr(self, 'rankers'):
+            self.rankers = [IncrementalRanker() for name in QUALITY_FACTORS]
+        
+        for i, name in enumerate(QUALITY_FACTORS):
+            out[name][:] = raw[i]
+            out[name + '_rank'][:] = self.rankers[i].rank(assets, raw[i])
+
+        
+                
+# PIPELINE PRECOMPUTATION (OFFLINE BACKTESTS)
+#---------------------------------------------
+# IN AN OFFLINE ZIPLINE BACKTEST, precompute_pipeline SPLITS THE SESSIONS INTO CHUNKS, RUNS EVERY 
+# CHUNK ON A PROCESS POOL AND STITCHES THE RESULTS. STORED IN PRECOMPUTED_PIPELINES (BY PIPELINE NAME) 
+# BEFORE THE BACKTEST STARTS, THAT PIPELINE IS NOT ATTACHED AND ITS DAILY OUTPUT BECOMES A LOOKUP. 
+# EACH CHUNK STARTS PIPELINE_LOOKBACK SESSIONS EARLY SO THAT FACTORS THAT KEEP STATE ACROSS DAYS 
+# (RUNNING SUMS, INCREMENTAL RANKS) ARE WARM; THOSE OVERLAP ROWS ARE DROPPED WHEN STITCHING.
+# run_chunk(start, end) MUST RETURN THE run_pipeline FRAME FOR make_pipeline() OVER [start, end], 
+# e.g. lambda start, end: engine.run_pipeline(make_pipeline(), start, end). WORKERS ARE FORKED, SO IT 
+# DOES NOT NEED TO BE PICKLABLE, BUT THIS FILE MUST BE IMPORTED AS A MODULE (e.g. imp.load_source).
+# THE QUANTOPIAN IDE HAS NO PROCESS POOLS, SO THERE PRECOMPUTED_PIPELINES STAYS EMPTY.
+# THE OUTPUT IS ONLY READ ON THE DAYS THE SCHEDULED FUNCTIONS RUN, SO WITH days (e.g. 
+# scheduled_sessions(sessions, 'month_start')) ONLY THOSE SESSIONS ARE EVALUATED, EACH WARMED UP overlap
+# SESSIONS EARLY; WARM-UPS THAT OVERLAP ARE MERGED INTO ONE JOB (UP TO chunk_size SESSIONS).
+# (NOTHING IN THIS PIPELINE NEEDS A WARM-UP: IncrementalRanker GIVES THE SAME RANKS FROM A COLD START 
+# AND THE WINDOWED FACTORS LOAD THEIR OWN WINDOWS, SO THE OVERLAP IS 0. WITH days EVERY month_start 
+# SESSION IS THEN ITS OWN ONE-DAY JOB, ABOUT 1/21 OF THE WORK OF EVALUATING EVERY SESSION)
+PIPELINE_LOOKBACK = 0
+PRECOMPUTED_PIPELINES = {}
+_CHUNK_RUNNER = None
+
+def precompute_pipeline(run_chunk, sessions, chunk_size=252, overlap=PIPELINE_LOOKBACK, processes=None, days=None):
+    
+    import multiprocessing
+    global _CHUNK_RUNNER
+    _CHUNK_RUNNER = run_chunk
+    
+    sessions = pd.DatetimeIndex(sessions)
+    if days is None:
+        starts = range(0, len(sessions), chunk_size)
+        jobs = [(max(start - overlap, 0), start, min(start + chunk_size, len(sessions)) - 1) for start in starts]
+    else:
+        days = pd.DatetimeIndex(days)
+        jobs = []
+        for day in sessions.searchsorted(days):
+            if jobs and day - overlap <= jobs[-1][2] + 1 and day - jobs[-1][1] < chunk_size:
+                jobs[-1][2] = day
+            else:
+                jobs.append([max(day - overlap, 0), day, day])
+    jobs = [(sessions[warm_start], sessions[start], sessions[end]) for warm_start, start, end in jobs]
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        frames = pool.map(_run_chunk, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    frame = pd.concat(frames)
+    if days is not None:
+        frame = frame[frame.index.get_level_values(0).isin(days)]
+    return frame
+
+# SESSIONS ON WHICH A date_rules.month_start() OR date_rules.week_start() FUNCTION RUNS 
+# (THE FIRST SESSION OF EVERY MONTH OR WEEK)
+def scheduled_sessions(sessions, rule):
+    sessions = pd.DatetimeIndex(sessions)
+    if rule == 'month_start':
+        period = np.asarray(sessions.year * 12 + sessions.month)
+    else:
+        period = np.asarray((sessions - pd.to_timedelta(sessions.dayofweek, unit='D')).normalize())
+    return sessions[np.concatenate([[True], period[1:] != period[:-1]])]
+
+def _run_chunk(job):
+    warm_start, start, end = job
+    frame = _CHUNK_RUNNER(warm_start, end)
+    return frame[frame.index.get_level_values(0) >= start]
+
+# ATTACH A PIPELINE UNLESS ITS OUTPUT WAS PRECOMPUTED
+def attach(pipe, name):
+    if name not in PRECOMPUTED_PIPELINES:
+        attach_pipeline(pipe, name)
+
+# TODAY'S OUTPUT OF A PIPELINE (A LOOKUP WHEN IT WAS PRECOMPUTED)
+def load_pipeline_output(name):
+    if name not in PRECOMPUTED_PIPELINES:
+        return pipeline_output(name)
+    return PRECOMPUTED_PIPELINES[name].xs(get_datetime().normalize(), level=0)
+
+
+# BUILD PIPELINE                      
+#----------------                     
+def make_pipeline():
     
-    # ADD VALUE FACTOR AND RANK
-    value = ValueFactor()
-    #pipe.add(value, 'value')
-    value_rank = value.rank(mask=universe)
-    #pipe.add(value_rank, 'value_rank') 
+    pipe = Pipeline()
    
+    # UNIVERSE DECLARATION (TOP 5000 STOCKS ACCORDING TO MARKET CAP)
+    #mkt_cap = MarketCap()
+    universe = QTradableStocksUS()#mkt_cap.top(5000)
     
-    # ADD LIQUIDITY FACTOR AND RANK
-    liquidity = Liquidity()
-    #pipe.add(liquidity, 'liquidity')            
-    liquidity_rank = liquidity.rank(mask=universe)
-    #pipe.add(liquidity_rank, 'liquidity_rank')
     
+    # ADD SECTOR TO THE PIPELINE
+    sector = Fundamentals.morningstar_sector_code.latest
+    pipe.add(sector, 'sector') 
+
     
-    # ADD MOMENTUM FACTOR AND RANK
-    momentum = Momentum()
-    #pipe.add(momentum, 'momentum')                  
-    momentum_rank = momentum.rank(mask=universe)
-    #pipe.add(momentum_rank, 'momentum_rank')                
+    # ADD ALL TEN QUALITY FACTORS AND THEIR RANKS (ONE FUSED PASS, SEE QualityFactors)
+    # ANY RAW FACTOR OR RANK CAN BE ADDED, e.g. pipe.add(quality.roe, 'roe')
+    quality = QualityFactors(mask=universe)
+    #pipe.add(quality.assetturn_rank, 'assetturn_rank')
+    
+    assetturn_rank = quality.assetturn_rank
+    roe_rank = quality.roe_rank
+    capex_rank = quality.capex_rank
+    debt_rank = quality.debt_rank
+    profit_rank = quality.profit_rank
+    solv_rank = quality.solv_rank
+    growth_rank = quality.growth_rank
+    value_rank = quality.value_rank
+    liquidity_rank = quality.liquidity_rank
+    momentum_rank = quality.momentum_rank
+    momentum = quality.momentum
                
     
     # TAKE THE AVG OF THE RANKS FOR AN OVERALL QUALITY RANK
@@ -260,18 +521,26 @@ def initialize(context):
     # YOU CAN PLAY WITH THE ARITHMETIC, BUT BE CAREFUL OF OVERFITTING
     # quality_score =  (value_rank + liquidity_rank)
     
-    pipe.add(quality_score.rank(mask=universe), 'quality_rank')
+    pipe.add(IncrementalRank(inputs=[quality_score], mask=universe), 'quality_rank')
     pipe.add(quality_score, 'quality score')   
     
+    # PIPELINE SCREEN SETTINGS
+    pipe.set_screen(universe & (momentum>0))
+    return pipe
+    
 
+                
+# INITIALIZE ALGORITHM                      
+#----------------------                     
+def initialize(context):
+    
+    # ATTACH PIPELINE NAME
+    attach(make_pipeline(), 'quality pipe')
     
     
 # SETTINGS
 #----------   
         
-    # PIPELINE SCREEN SETTINGS
-    pipe.set_screen(universe & (momentum>0))
-    
     # BENCHMARK SETTINGS (SPY DEFAULT)
     #set_benchmark(symbol('SPY'))
     
@@ -302,16 +571,18 @@ def initialize(context):
                     
                
         
-# EVERYDAY BEFORE TRADING START: 
-#--------------------------------                 
-def before_trading_start(context, data):
+# LOAD THE BASKETS (ONLY ON REBALANCE DAYS, THE ONLY DAYS THE OUTPUT IS READ): 
+#-----------------------------------------------------------------------------                 
+def load_baskets(context):
     
-    # CALL PIPELINE BEFORE TRADING START (FILL N/A IS DEFAULT TO NaN)
-    context.output = pipeline_output('quality pipe').fillna(1000)
+    # CALL PIPELINE (FILL N/A IS DEFAULT TO NaN)
+    context.output = load_pipeline_output('quality pipe').fillna(1000)
       
     # DEFINE NUMBER OF SECURITIES TO LONG AND SHORT BASED ON INDEX LOCATION 
-    context.long_list = context.output.sort_values(['quality_rank'], ascending=False).iloc[:100]
-    context.short_list = context.output.sort_values(['quality_rank'], ascending=False).iloc[-100:]   
+    # (ROW POSITIONS IN context.output AND THE MATCHING ASSETS, HIGHEST QUALITY RANK FIRST)
+    context.long_idx, context.short_idx = select_baskets(context.output['quality_rank'].values, 100)
+    context.long_list = context.output.index[context.long_idx]
+    context.short_list = context.output.index[context.short_idx]
 
                 
                 
@@ -322,12 +593,14 @@ def record_vars(context, data):
     # RECORDED METRICS DURING BACKTEST -- LEVERAGE 
     record(leverage = context.account.leverage)
         
-    # PRINT TOP 10 DAILY LONG AND SHORT POSITIONS
+    # PRINT TOP 10 DAILY LONG AND SHORT POSITIONS (THE BASKETS OF THE LAST REBALANCE)
+    if not hasattr(context, 'output'):
+        return
     print "Long List"
-    log.info("\n" + str(context.long_list.sort_values(['quality_rank'], ascending=True).head(10)))
+    log.info("\n" + str(context.output.iloc[context.long_idx[::-1][:10]]))
     
     print "Short List" 
-    log.info("\n" + str(context.short_list.sort_values(['quality_rank'], ascending=True).head(10)))      
+    log.info("\n" + str(context.output.iloc[context.short_idx[::-1][:10]]))      
                 
                 
                
@@ -335,28 +608,50 @@ def record_vars(context, data):
 #-----------  
 def rebalance(context,data):
     
+    # PIPELINE OUTPUT AND BASKETS FOR THIS MONTH
+    load_baskets(context)
+    
     # DEFINE THE TARGET WEIGHT OF EACH STOCK IN THE PORTFOLIO
     long_weight = context.long_leverage / float(len(context.long_list))
     short_weight = context.short_leverage / float(len(context.short_list))
 
-    # FOR EACH STOCK THAT WE HAVE CLASSIFIED IN OUR LONG AND SHORT LISTS, 
-    # WE WANT TO PLACE A MARKET ORDER BASED ON THE DEFINED TARGET PERCENT. 
-    # THE ORDER WILL BE EXECUTED WHEN THE FUNCTION IS SCHEDULED TO BE CALLED 
-    # (SEE SETTINGS)
-    
-    for long_stock in context.long_list.index:
-        log.info("ordering longs")
-        log.info("weight is %s" % (long_weight))
-        order_target_percent(long_stock, long_weight)
-        
-    for short_stock in context.short_list.index:
-        log.info("ordering shorts")
-        log.info("weight is %s" % (short_weight))
-        order_target_percent(short_stock, short_weight)
-        
-    # EXIT ANY POSITIONS THAT ARE NO LONGER ON OUR LONG OR SHORT LIST    
-    for stock in context.portfolio.positions.iterkeys():
-        if stock not in context.long_list.index and stock not in context.short_list.index:
-            order_target(stock, 0)
+    # BUILD ONE TARGET WEIGHT VECTOR FOR BOTH LISTS (A STOCK ON BOTH LISTS KEEPS ITS SHORT WEIGHT).
+    # ANY HELD POSITION THAT IS NOT IN THE VECTOR HAS A TARGET OF 0, SO THE OPTIMIZER DIFFS THE 
+    # WEIGHTS AGAINST CURRENT HOLDINGS AND SUBMITS EVERY ORDER, INCLUDING THE EXITS, AS ONE BATCH
+    # WHEN THE FUNCTION IS SCHEDULED TO BE CALLED (SEE SETTINGS)
+    weights = pd.Series(np.concatenate([np.full(len(context.long_list), long_weight), 
+                                        np.full(len(context.short_list), short_weight)]), 
+                        index=context.long_list.append(context.short_list))
+    weights = weights[~weights.index.duplicated(keep='last')]
+    
+    log.info("ordering %s longs at weight %s and %s shorts at weight %s" % (len(context.long_list), long_weight, 
+                                                                          len(context.short_list), short_weight))
+    order_optimal_portfolio(opt.TargetWeights(weights), constraints=[])
             
                  
+
+
+
+# BASKET SELECTION
+#------------------
+# RETURN THE POSITIONS OF THE k HIGHEST AND k LOWEST VALUES, BOTH ORDERED FROM HIGHEST TO LOWEST 
+# (THE SAME ROWS AS sort_values(ascending=False).iloc[:k] AND .iloc[-k:], WITH NaN RANKED LAST).
+# ONE argpartition SPLITS OFF BOTH TAILS IN LINEAR TIME, THEN ONLY THE 2k SELECTED ROWS ARE SORTED
+def select_baskets(values, k):
+    
+    values = np.asarray(values, dtype=float)
+    values = np.where(np.isnan(values), -np.inf, values)
+    n = len(values)
+    k = min(k, n)
+    
+    if k == 0:
+        empty = np.array([], dtype=int)
+        return empty, empty
+    
+    part = np.argpartition(values, sorted(set([k - 1, n - k])))
+    top = part[n - k:]
+    bottom = part[:k]
+    
+    top = top[np.argsort(-values[top], kind='mergesort')]
+    bottom = bottom[np.argsort(-values[bottom], kind='mergesort')]
+    return top, bottom
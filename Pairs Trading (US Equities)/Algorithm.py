@@ -5,252 +5,420 @@
 # * THIS MODEL IS SIMPLY A FRAMEWORK, AS THE BELOW PAIRS ARE CURRENTLY NO LONGER COINTEGRATED *
 import numpy as np
 
-def initialize(context):
+# PAIRS TABLE
+#-------------
+# (scan_pairs / pairs_table BELOW FIND AND FORMAT CURRENTLY COINTEGRATED PAIRS FOR THIS TABLE)
+# ONE ROW PER PAIR: (LEG A SID, LEG B SID, LOOKBACK, SHORT ENTRY, LONG ENTRY, EXIT, WEIGHT A, WEIGHT B, 
+# HEDGE). THE SPREAD IS A - HEDGE * B (HEDGE IS THE SLOPE OF THE COINTEGRATING REGRESSION). WE SHORT THE SPREAD WHEN ITS Z SCORE IS ABOVE SHORT ENTRY, GO LONG WHEN IT IS 
+# BELOW LONG ENTRY AND EXIT WHEN |Z| IS BELOW EXIT. WEIGHT A / WEIGHT B ARE THE TARGET PERCENTS OF THE 
+# LEGS WHILE SHORT THE SPREAD (NEGATED WHILE LONG). ADD OR COMMENT OUT ROWS TO CHANGE THE PORTFOLIO.
+PAIRS = [
+    # AIRLINES (AMERICAN/UNITED)
+    (45971, 28051, 21, 1.0, 1.0, 0.25, -0.5, 0.5, 1.0),
+    # TECH (GOOGLE/FACEBOOK)
+    #(26578, 42950, 21, 1.0, 1.0, 0.25, -0.5, 0.5, 1.0),
+    # ENERGY (ABGB/FIRST SOLAR)
+    (45676, 32902, 21, 1.0, 1.0, 0.25, 0.5, -0.5, 1.0),
+    # CURRENCY (AUSTRALIA/CANADA)
+    #(14516, 14517, 21, 1.0, 1.0, 0.25, 0.5, -0.5, 1.0),
+]
+
+
+# ROLLING SPREAD STATISTICS
+#---------------------------
+# MEAN AND VARIANCE OF THE LAST lengths[p] VALUES OF EVERY PAIR p, UPDATED IN O(1) PER PUSHED BAR: 
+# WHILE A WINDOW FILLS EACH VALUE IS ADDED WITH WELFORD'S UPDATE, ONCE IT IS FULL THE NEW VALUE 
+# REPLACES THE OLDEST ONE IN A SINGLE STABLE ADD-AND-REMOVE STEP (THE RING KEEPS THE VALUES THAT STILL 
+# HAVE TO LEAVE). EVERY lengths[p] PUSHES THE WINDOW IS SUMMED AGAIN FROM THE RING (STILL O(1) PER 
+# BAR ON AVERAGE) SO ROUNDING ERRORS CANNOT BUILD UP. A NaN EMPTIES THAT PAIR'S WINDOW, WHICH THEN REFILLS, SO LIKE np.mean / np.std OVER A
+# WINDOW WITH A GAP THERE IS NO Z SCORE UNTIL lengths[p] CLEAN VALUES ARRIVED.
+class RollingSpreadStats(object):
     
-    # INITIALIZE PAIRS
-    #-----------------
-    # AIRLINES
-    context.aa = sid(45971)
-    context.ual = sid(28051)
-    # TECH
-    context.goog = sid(26578)
-    context.fb = sid(42950)
-    # ENERGY 
-    context.abgb = sid(45676)
-    context.fslr = sid(32902)
-    # CURRENCY 
-    context.aud = sid(14516)
-    context.cad = sid(14517) 
+    def __init__(self, lengths):
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.ring = np.full((max(self.lengths.max(), 1) if len(self.lengths) else 1, len(self.lengths)), np.nan)
+        self.head = 0
+        self.count = np.zeros(len(self.lengths), dtype=int)
+        self.mean = np.zeros(len(self.lengths))
+        self.m2 = np.zeros(len(self.lengths))
+        self.fresh = np.zeros(len(self.lengths), dtype=int)
     
-    # IDEALLY WE WOULD HAVE A MULTITUDE OF PAIRS THAT WE HAVE CONFIRMED 
-    # ARE *CURRENTLY* COINTEGRATED PER OUR RESEARCH. ADDITIONAL PAIRS
-    # ACTS AS A DIVERSIFICATION TOOL THAT PROTECTS THE PORTFOLIO FROM A 
-    # PAIR DROPPING OUT OF COINTEGRATION --THUS NO ASSUMPTIONS CAN
-    # CONTINUE TO BE MADE THAT THE SPREAD BETWEEN THE PAIR IS MEAN REVERTING.
-    # DUE TO THIS FUNDAMENTAL PHENOMENON, WE MUST BE RIGOROUS IN TESTING NOT
-    # ONLY NEW PAIRS, BUT ALSO OUR CURRENT ONES FOR CONTINUED COINTEGRATION.        
+    # ADD ONE BAR (ONE VALUE PER PAIR)
+    def push(self, values):
+        
+        x = np.asarray(values, dtype=float)
+        size = len(self.ring)
+        full = self.count == self.lengths
+        old = self.ring[(self.head - self.lengths) % size, np.arange(len(x))]
+        self.ring[self.head % size] = x
+        self.head += 1
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            count = np.where(full, self.count, self.count + 1)
+            mean = np.where(full, self.mean + (x - old) / count, self.mean + (x - self.mean) / count)
+            m2 = np.where(full, self.m2 + (x - old) * (x - mean + old - self.mean), 
+                          self.m2 + (x - self.mean) * (x - mean))
+        
+        missing = np.isnan(x)
+        self.count = np.where(missing, 0, count)
+        self.mean = np.where(missing, 0.0, mean)
+        self.m2 = np.where(missing, 0.0, np.maximum(m2, 0.0))
+        self.fresh = np.where(missing, 0, self.fresh + 1)
+        
+        stale = np.flatnonzero((self.count == self.lengths) & (self.fresh >= self.lengths))
+        if len(stale):
+            self._recompute(stale)
+    
+    # EXACT MEAN AND M2 OF THE WINDOWS OF THE pairs (FROM THE RING)
+    def _recompute(self, pairs):
+        
+        age = (self.head - 1 - np.arange(len(self.ring))) % len(self.ring)
+        window = age[:, None] < self.lengths[pairs]
+        values = self.ring[:, pairs]
+        mean = np.where(window, values, 0.0).sum(axis=0) / self.lengths[pairs]
+        self.mean[pairs] = mean
+        self.m2[pairs] = np.where(window, (values - mean) ** 2, 0.0).sum(axis=0)
+        self.fresh[pairs] = 0
+    
+    # REPLACE THE WINDOWS OF pairs BY THE LAST lengths[p] ROWS OF values (ONE COLUMN PER PAIR, OLDEST 
+    # ROW FIRST), WITH THE SAME NaN RULE AS push
+    def reseed(self, pairs, values):
+        
+        size = len(self.ring)
+        for k, p in enumerate(pairs):
+            window = values[max(len(values) - self.lengths[p], 0):, k]
+            self.ring[(self.head - len(window) + np.arange(len(window))) % size, p] = window
+            gaps = np.flatnonzero(np.isnan(window))
+            clean = window[gaps[-1] + 1:] if len(gaps) else window
+            self.count[p] = len(clean)
+            self.mean[p] = clean.mean() if len(clean) else 0.0
+            self.m2[p] = ((clean - self.mean[p]) ** 2).sum()
+            self.fresh[p] = 0
     
-    # SCHEDULE FUNCTIONS
-    schedule_function(check_pairs1, date_rules.every_day(), time_rules.market_open())
-    #schedule_function(check_pairs2, date_rules.every_day(), time_rules.market_open())
-    schedule_function(check_pairs3, date_rules.every_day(), time_rules.market_open())
-    #schedule_function(check_pairs4, date_rules.month_start(), time_rules.market_open())
+    # Z SCORE AND (POPULATION) STDEV OF current AGAINST THE FULL WINDOW EXTENDED BY current ITSELF 
+    # (WITHOUT PUSHING IT); NaN WHILE A WINDOW IS NOT FULL
+    def zscores(self, current):
+        
+        x = np.asarray(current, dtype=float)
+        n = self.count + 1.0
+        mean = self.mean + (x - self.mean) / n
+        std = np.sqrt((self.m2 + (x - self.mean) * (x - mean)) / n)
+        std = np.where(self.count == self.lengths, std, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (x - mean) / std, std
+
+
+# PAIRS ENGINE
+#--------------
+# KEEPS THE TABLE AND THE POSITION OF EVERY PAIR IN ARRAYS (state: 1 = LONG THE SPREAD, -1 = SHORT, 
+# 0 = FLAT). assets IS THE UNION OF ALL LEGS, SO ONE data.history CALL COVERS EVERY PAIR, AND ALL 
+# SPREADS, Z SCORES AND SIGNALS ARE COMPUTED AS ARRAY OPERATIONS OVER THE PAIRS. THE LAST LOOKBACK - 1 
+# CLOSES OF EVERY SPREAD LIVE IN RollingSpreadStats, SO ONLY THE FIRST CALL NEEDS bars ROWS OF HISTORY; 
+# AFTER THAT history_bars IS 3 (THE LAST PUSHED CLOSE, YESTERDAY'S CLOSE AND TODAY'S PRICE). THE STORED 
+# SPREADS ARE NEVER ADJUSTED AGAIN, SO stale COMPARES THE RE-PULLED CLOSES OF last_day WITH THE ONES 
+# PUSHED: A SPLIT OR DIVIDEND IN A LEG RE-ADJUSTS ITS HISTORY, AND THE PAIRS OF THAT LEG ARE RESEEDED 
+# FROM A FULL RE-ADJUSTED LOOKBACK (A SPREAD OF TWO LEGS CANNOT BE RESCALED BY ONE LEG'S RATIO).
+class PairsEngine(object):
+    
+    def __init__(self, pairs):
+        
+        self.assets = []
+        position = {}
+        for row in pairs:
+            for asset in row[:2]:
+                if asset not in position:
+                    position[asset] = len(self.assets)
+                    self.assets.append(asset)
+        
+        table = np.array([row[2:] for row in pairs], dtype=float).reshape(-1, 7)
+        self.leg_a = np.array([position[row[0]] for row in pairs], dtype=int)
+        self.leg_b = np.array([position[row[1]] for row in pairs], dtype=int)
+        self.lookback = table[:, 0].astype(int)
+        self.short_entry, self.long_entry, self.exit = table[:, 1], table[:, 2], table[:, 3]
+        self.weight_a, self.weight_b, self.hedge = table[:, 4], table[:, 5], table[:, 6]
+        self.state = np.zeros(len(pairs), dtype=np.int8)
+        self.bars = int(self.lookback.max()) if len(pairs) else 0
+        self.stats = RollingSpreadStats(self.lookback - 1)
+        self.last_day = None
+        self.closes = np.full(len(self.assets), np.nan)
     
-    # INITIALIZE THE FIRST LONG/SHORT POSITIONS TO FALSE SINCE WE HAVE NO TRADES YET
-    context.long_on_spread1 = False
-    context.shorting_spread1 = False
+    # ROWS OF DAILY HISTORY THE NEXT update NEEDS
+    def history_bars(self):
+        return self.bars if self.last_day is None else 3
     
-    # INITIALIZE THE SECOND LONG/SHORT POSITIONS TO FALSE SINCE WE HAVE NO TRADES YET
-    context.long_on_spread2 = False
-    context.shorting_spread2 = False
+    # PAIRS WITH A LEG WHOSE CLOSE ON last_day IN prices (SAME LAYOUT AS FOR update) IS NOT THE ONE 
+    # THAT WAS PUSHED (A MISSING CLOSE WAS PUSHED AS A NaN SPREAD, WHICH LEFT NOTHING TO RE-ADJUST)
+    def stale(self, prices, days):
+        
+        rows = np.flatnonzero(np.asarray(days == self.last_day)) if self.last_day is not None else []
+        if not len(rows):
+            return np.zeros(0, dtype=int)
+        close = prices[rows[0]]
+        known = np.isfinite(close) & np.isfinite(self.closes)
+        moved = known & ~np.isclose(close, self.closes, rtol=1e-9, atol=0.0)
+        return np.flatnonzero(moved[self.leg_a] | moved[self.leg_b])
     
-    # INITIALIZE THE THIRD LONG/SHORT POSITIONS TO FALSE SINCE WE HAVE NO TRADES YET
-    context.long_on_spread3 = False
-    context.shorting_spread3 = False
+    # REBUILD THE WINDOWS OF pairs FROM prices / days (bars + 1 ROWS ENDING TODAY, SO THE CLOSES UP TO 
+    # last_day STILL FILL THE LONGEST LOOKBACK WHEN YESTERDAY IS NOT PUSHED YET)
+    def reseed(self, pairs, prices, days):
+        
+        rows = np.flatnonzero(np.asarray(days[:-1] <= self.last_day))
+        closes = prices[rows]
+        spread = closes[:, self.leg_a[pairs]] - self.hedge[pairs] * closes[:, self.leg_b[pairs]]
+        self.stats.reseed(pairs, spread)
+        self.closes = closes[-1]
     
-    # INITIALIZE THE FOURTH LONG/SHORT POSITIONS TO FALSE SINCE WE HAVE NO TRADES YET
-    context.long_on_spread4 = False
-    context.shorting_spread4 = False
+    # MOVE EVERY PAIR TO ITS NEW STATE AND RETURN THE TARGET PERCENT OF EVERY ASSET (SUMMED OVER ITS 
+    # PAIRS) WITH THE POSITIONS (IN self.assets) OF THE ASSETS WHOSE PAIRS CHANGED STATE 
+    # (prices IS history_bars() x assets, COLUMNS IN THE ORDER OF self.assets, days ITS DATES; THE 
+    # LAST ROW IS TODAY, THE EARLIER ROWS ARE CLOSES AND ONLY THE ONES NOT SEEN YET ARE PUSHED)
+    def update(self, prices, days):
+        
+        spread = prices[:, self.leg_a] - self.hedge * prices[:, self.leg_b]
+        for i in range(len(days) - 1):
+            if self.last_day is None or days[i] > self.last_day:
+                self.stats.push(spread[i])
+                self.last_day = days[i]
+                self.closes = prices[i]
+        
+        # Z SCORE OF TODAY'S SPREAD AGAINST ITS LOOKBACK MEAN AND (POPULATION) STDEV
+        zscore, std = self.stats.zscores(spread[-1])
+        valid = std > 0
+        
+        # SAME ORDER OF CHECKS AS A SINGLE PAIR: SHORT ENTRY, THEN LONG ENTRY, THEN EXIT
+        short = valid & (zscore > self.short_entry) & (self.state != -1)
+        long = valid & ~short & (zscore < self.long_entry) & (self.state != 1)
+        flat = valid & ~short & ~long & (np.abs(zscore) < self.exit)
+        
+        state = self.state.copy()
+        state[short] = -1
+        state[long] = 1
+        state[flat] = 0
+        changed = np.flatnonzero(state != self.state)
+        self.state = state
+        
+        targets = np.zeros(len(self.assets))
+        np.add.at(targets, self.leg_a, -state * self.weight_a)
+        np.add.at(targets, self.leg_b, -state * self.weight_b)
+        return targets, np.unique(np.concatenate([self.leg_a[changed], self.leg_b[changed]]))
+
+
+# COINTEGRATION SCANNER (RESEARCH / OFFLINE)
+#--------------------------------------------
+# ENGLE-GRANGER TEST OF EVERY PAIR OF NAMES INSIDE THE SAME SECTOR OVER window BARS ENDING AT EACH 
+# DATE IN ends (DEFAULT: THE LAST ONE). LEG A IS REGRESSED ON LEG B (WITH A CONSTANT) AND THE RESIDUAL 
+# GETS AN ADF TEST WITH lags LAGGED DIFFERENCES -- THE SAME STATISTIC AND P-VALUE AS statsmodels 
+# coint(a, b, maxlag=lags, autolag=None), BUT THOUSANDS OF PAIRS ARE SOLVED AT ONCE AS STACKED 
+# LEAST SQUARES (P-VALUES INCLUDED), AND THE BATCHES RUN ON A PROCESS POOL. RESULTS ARE KEPT IN cache 
+# AS ARRAYS PER (WINDOW END, WINDOW, LAGS), SO A ROLLING RE-SCAN ONLY TESTS THE NEW WINDOWS AND FINDS 
+# THE CACHED PAIRS WITH ONE SORTED LOOKUP INSTEAD OF A PER-PAIR CHECK. prices IS A (DATES x SIDS) FRAME, sectors MAPS SIDS TO SECTOR CODES. RETURNS THE PAIRS WITH 
+# pvalue <= max_pvalue, STRONGEST (MOST NEGATIVE t) FIRST, WITH THE HEDGE RATIO beta AND THE LEG PRICES 
+# AT THE WINDOW END; pairs_table TURNS THE TOP ROWS INTO PAIRS TABLE ROWS. A PAIR WITH A FLAT LEG OR 
+# (ALMOST) PERFECTLY COLLINEAR LEGS HAS NO RESIDUAL TO TEST (statsmodels WARNS AND RETURNS t = -inf) 
+# AND GETS NaN, LIKE A PAIR WITH MISSING PRICES.
+# WORKERS ARE FORKED, SO THIS FILE MUST BE IMPORTED AS A MODULE (e.g. imp.load_source).
+COINT_CACHE = {}
+_SCAN_PRICES = None
 
+def scan_pairs(prices, sectors, window=252, ends=None, lags=1, max_pvalue=0.05, batch_size=20000, 
+               processes=None, cache=COINT_CACHE):
     
-# AIRLINE PAIR TRADE (AMERICAN/UNITED)
-def check_pairs1(context,data):
+    import multiprocessing
+    import pandas as pd
+    global _SCAN_PRICES
     
-# IN A FRAMEWORK WITH MULTIPLE PAIRS TRADING AT ONCE, WE WOULD ALLOCATE 
-# LESS CAPITAL TO EACH PAIR AND SIMPLY COPY/PASTE THE CHECK_PAIRS TRADING FORMULA  
-# RESPECTIVE TO EACH PAIR TRADING STRATEGY. KEEP IN MIND THAT CERTAIN VARIABLES MAY  
-# NEED TO BE TWEAKED ACROSS DIFFERENT STRATEGIES --NAMELY THE LOOKBACK PERIOD, 
-# TARGET PORTFOLIO WEIGHTS, AND POTENTIALLY THE Z SCORE THRESHOLDS (TRADE SIGNALS).
+    sids = np.asarray(prices.columns)
+    _SCAN_PRICES = (np.asarray(prices.values, dtype=float), window, lags)
+    ends = [prices.index[-1]] if ends is None else list(ends)
+    codes = pd.Series(sectors).reindex(sids).values
+    
+    # CANDIDATE PAIRS (EVERY i < j INSIDE A SECTOR) THAT ARE NOT CACHED YET, IN BATCHES
+    candidates = []
+    for code in pd.unique(codes[pd.notnull(codes)]):
+        members = np.flatnonzero(codes == code)
+        i, j = np.triu_indices(len(members), 1)
+        candidates.append((members[i], members[j]))
+    leg_a = np.concatenate([c[0] for c in candidates]) if candidates else np.zeros(0, dtype=int)
+    leg_b = np.concatenate([c[1] for c in candidates]) if candidates else np.zeros(0, dtype=int)
+    
+    jobs = []
+    for end in ends:
+        stop = prices.index.get_loc(end) + 1
+        todo = _cache_slots(cache.get((end, window, lags)), sids, leg_a, leg_b) < 0
+        a, b = leg_a[todo], leg_b[todo]
+        jobs += [(end, stop, a[k:k + batch_size], b[k:k + batch_size]) for k in range(0, len(a), batch_size)]
+    
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_coint_batch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        tested = {}
+        for (end, stop, a, b), result in zip(jobs, results):
+            tested.setdefault(end, []).append((a, b) + tuple(result))
+        for end, parts in tested.items():
+            _cache_store(cache, (end, window, lags), sids, *[np.concatenate(part) for part in zip(*parts)])
+    
+    columns = ['sid_a', 'sid_b', 'end', 'tstat', 'pvalue', 'beta', 'price_a', 'price_b']
+    frames = []
+    for end in ends:
+        entry = cache.get((end, window, lags))
+        if entry is None:
+            continue
+        slots = _cache_slots(entry, sids, leg_a, leg_b)
+        tstat, pvalue, beta = entry[2][slots], entry[3][slots], entry[4][slots]
+        keep = pvalue <= max_pvalue
+        a, b = leg_a[keep], leg_b[keep]
+        last = _SCAN_PRICES[0][prices.index.get_loc(end)]
+        frames.append(pd.DataFrame({'sid_a': sids[a], 'sid_b': sids[b], 'end': [end] * len(a), 
+                                    'tstat': tstat[keep], 'pvalue': pvalue[keep], 'beta': beta[keep], 
+                                    'price_a': last[a], 'price_b': last[b]}, columns=columns))
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    return table.sort_values(['end', 'tstat']).reset_index(drop=True)
 
-    aa = context.aa
-    ual = context.ual
+# A cache ENTRY IS (SIDS, CODES, TSTAT, PVALUE, BETA) ARRAYS: THE PAIR OF LEGS AT POSITIONS (a, b) OF 
+# SIDS HAS CODE a * len(SIDS) + b, AND THE CODES ARE SORTED. _cache_slots GIVES THE POSITIONS IN entry 
+# OF THE PAIRS (sids[leg_a], sids[leg_b]) (-1 FOR PAIRS NOT TESTED YET)
+def _cache_slots(entry, sids, leg_a, leg_b):
     
-    # EACH TIME THE FUNCTION IS CALLED, RETURN THE 21 DAY PRICE HISTORY
-    prices = data.history([aa,ual],'price',21,'1d')
+    import pandas as pd
+    if entry is None or not len(entry[1]):
+        return np.full(len(leg_a), -1, dtype=np.int64)
+    where = pd.Index(entry[0]).get_indexer(sids).astype(np.int64)
+    a, b = where[leg_a], where[leg_b]
+    code = a * len(entry[0]) + b
+    slots = np.minimum(np.searchsorted(entry[1], code), len(entry[1]) - 1)
+    return np.where((a >= 0) & (b >= 0) & (entry[1][slots] == code), slots, -1)
+
+# ADD THE RESULTS OF THE PAIRS (sids[a], sids[b]) TO THE cache ENTRY key (SIDS THE ENTRY DOES NOT 
+# HAVE YET ARE APPENDED TO ITS SIDS, SO THE CODES OF THE PAIRS IT ALREADY HOLDS ARE ONLY RESCALED)
+def _cache_store(cache, key, sids, a, b, tstat, pvalue, beta):
     
-    # RETURN MOST RECENT DAYS PRICES BASED ON ILOC[-1:]
-    short_prices = prices.iloc[-1:] 
+    import pandas as pd
+    entry = cache.get(key)
+    known = pd.Index(sids[:0] if entry is None else entry[0])
+    union = known.append(pd.Index(sids)[~pd.Index(sids).isin(known)])
+    where = union.get_indexer(sids).astype(np.int64)
+    code = where[a] * len(union) + where[b]
+    if entry is not None:
+        code = np.concatenate([entry[1] // len(known) * len(union) + entry[1] % len(known), code])
+        tstat, pvalue, beta = [np.concatenate([old, new]) for old, new in zip(entry[2:], (tstat, pvalue, beta))]
+    order = np.argsort(code, kind='mergesort')
+    cache[key] = (np.asarray(union), code[order], tstat[order], pvalue[order], beta[order])
+
+def _coint_batch(job):
     
-    # AVERAGE OF THE 21 DAY PRICE SPREAD  
-    mavg_21 = np.mean(prices[aa] - prices[ual])
-    # STDEV OF THE 21 DAY PRICE SPREAD
-    std_21 = np.std(prices[aa] - prices[ual])
+    end, stop, a, b = job
+    prices, window, lags = _SCAN_PRICES
+    bars = prices[max(stop - window, 0):stop]
     
-    # AVERAGE OF THE MOST RECENT DAYS PRICE SPREAD
-    mavg_1 = np.mean(short_prices[aa] - short_prices[ual])
+    # COINTEGRATING REGRESSION a = alpha + beta * b FOR EVERY PAIR (COLUMNS)
+    y = bars[:, a] - bars[:, a].mean(axis=0)
+    x = bars[:, b] - bars[:, b].mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = (x * y).sum(axis=0) / (x * x).sum(axis=0)
+    resid = y - beta * x
     
-    # IF OUR STDEV IS GREATER THAN 0...
-    if std_21 > 0:
-        
-        # CALCULATE THE Z SCORE BY DIVIDING (TODAYS AVERAGE SPREAD - THE 21 DAY AVERAGE SPREAD) 
-        # BY THE 30 DAY STDEV
-        zscore = (mavg_1 - mavg_21) / std_21
-        
-        # IF THE Z SCORE IS GREATER THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION
-        if zscore > 1.0 and not context.shorting_spread1:
-            order_target_percent(aa,-0.5)
-            order_target_percent(ual,0.5)
-            context.shorting_spread1 = True
-            context.long_on_spread1 = False
-            
-        # IF THE Z SCORE IS LESS THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION    
-        elif zscore < 1.0 and not context.long_on_spread1:
-            order_target_percent(aa,0.5)
-            order_target_percent(ual,-0.5)
-            context.shorting_spread1 = False
-            context.long_on_spread1 = True
-        
-        # IF THE Z SCORE IS LESS THAN 0.25 WE ASSUME THE MEAN HAS REVERTED (ENOUGH), SO WE EXIT OUT PAIRED POSITIONS
-        elif abs(zscore) < 0.25:
-            order_target_percent(aa,0)
-            order_target_percent(ual,0)
-            context.shorting_spread1 = False
-            context.long_on_spread1 = False   
+    # R SQUARED OF THE REGRESSION (statsmodels' COLLINEARITY CHECK; NaN WHEN LEG A IS FLAT)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsquared = 1.0 - (resid ** 2).sum(axis=0) / (y * y).sum(axis=0)
+    
+    # ADF REGRESSION (NO CONSTANT): diff_t = gamma * resid_t-1 + phi_1 * diff_t-1 + ... + phi_lags * diff_t-lags
+    diff = np.diff(resid, axis=0)
+    design = np.stack([resid[lags:-1]] + [diff[lags - l:len(diff) - l] for l in range(1, lags + 1)], axis=-1)
+    target = diff[lags:]
+    valid = np.isfinite(design).all(axis=(0, 2)) & np.isfinite(target).all(axis=0)
+    valid &= rsquared < 1 - 100 * np.sqrt(np.finfo(float).eps)
+    design[:, ~valid] = 0.0
+    target[:, ~valid] = 0.0
+    
+    xtx = np.einsum('tbi,tbj->bij', design, design)
+    xtx[~valid] = np.eye(lags + 1)
+    xty = np.einsum('tbi,tb->bi', design, target)
+    inverse = np.linalg.inv(xtx)
+    coef = np.einsum('bij,bj->bi', inverse, xty)
+    residual = target - np.einsum('tbi,bi->tb', design, coef)
+    variance = (residual ** 2).sum(axis=0) / (len(target) - lags - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstat = np.where(valid, coef[:, 0] / np.sqrt(variance * inverse[:, 0, 0]), np.nan)
+    pvalue = np.where(np.isfinite(tstat), mackinnon_pvalue(tstat), np.nan)
+    return tstat, pvalue, beta
 
-            
-# TECH PAIR TRADE (GOOGLE/FACEBOOK)            
-def check_pairs2(context,data):
+# MACKINNON (2010) P-VALUE SURFACE FOR THE ENGLE-GRANGER t STATISTIC WITH A CONSTANT AND 2 VARIABLES 
+# (THE COEFFICIENTS OF statsmodels mackinnonp(t, regression='c', N=2)), FOR AN ARRAY OF t STATISTICS
+MACKINNON_TAU_MAX = 0.92
+MACKINNON_TAU_MIN = -18.86
+MACKINNON_TAU_STAR = -2.62
+MACKINNON_SMALL_P = [2.92, 1.5012, 0.039796]
+MACKINNON_LARGE_P = [2.1945, 0.64695, -0.29198, -0.042377]
 
-    goog = context.goog
-    fb = context.fb
+def mackinnon_pvalue(tstat):
     
-    # EACH TIME THE FUNCTION IS CALLED, RETURN THE 21 DAY PRICE HISTORY
-    prices = data.history([goog,fb],'price',21,'1d')
+    from scipy.stats import norm
+    tstat = np.asarray(tstat, dtype=float)
+    small = np.polyval(MACKINNON_SMALL_P[::-1], tstat)
+    large = np.polyval(MACKINNON_LARGE_P[::-1], tstat)
+    pvalue = norm.cdf(np.where(tstat <= MACKINNON_TAU_STAR, small, large))
+    return np.where(tstat > MACKINNON_TAU_MAX, 1.0, np.where(tstat < MACKINNON_TAU_MIN, 0.0, pvalue))
+
+# PAIRS TABLE ROWS FOR THE count STRONGEST PAIRS OF A SCAN (ONE WINDOW END), gross SPLIT EVENLY. EACH 
+# PAIR TRADES A - beta * B, SO LEG B HOLDS beta SHARES PER SHARE OF LEG A: AT THE WINDOW-END PRICES 
+# ITS WEIGHT IS beta * price_b / price_a TIMES THE WEIGHT OF LEG A
+def pairs_table(scan, count, lookback=21, short_entry=1.0, long_entry=1.0, exit=0.25, gross=1.0):
+    top = scan.head(count)
+    gross = gross / max(len(top), 1)
+    rows = []
+    for row in top.itertuples():
+        hedge = row.beta * row.price_b / row.price_a
+        weight = gross / (1.0 + abs(hedge))
+        rows.append((int(row.sid_a), int(row.sid_b), lookback, short_entry, long_entry, exit, 
+                     -weight, hedge * weight, float(row.beta)))
+    return rows
+
+
+def initialize(context):
     
-    # RETURN MOST RECENT DAYS PRICES BASED ON ILOC[-1:]
-    short_prices = prices.iloc[-1:] 
+    # INITIALIZE PAIRS FROM THE PAIRS TABLE (ALL PAIRS START FLAT SINCE WE HAVE NO TRADES YET)
+    #-----------------
+    context.pairs = PairsEngine([(sid(row[0]), sid(row[1])) + tuple(row[2:]) for row in PAIRS])
     
-    # AVERAGE OF THE 21 DAY PRICE SPREAD  
-    mavg_21 = np.mean(prices[goog] - prices[fb])
-    # STDEV OF THE 21 DAY PRICE SPREAD
-    std_21 = np.std(prices[goog] - prices[fb])
+    # IDEALLY WE WOULD HAVE A MULTITUDE OF PAIRS THAT WE HAVE CONFIRMED 
+    # ARE *CURRENTLY* COINTEGRATED PER OUR RESEARCH. ADDITIONAL PAIRS
+    # ACTS AS A DIVERSIFICATION TOOL THAT PROTECTS THE PORTFOLIO FROM A 
+    # PAIR DROPPING OUT OF COINTEGRATION --THUS NO ASSUMPTIONS CAN
+    # CONTINUE TO BE MADE THAT THE SPREAD BETWEEN THE PAIR IS MEAN REVERTING.
+    # DUE TO THIS FUNDAMENTAL PHENOMENON, WE MUST BE RIGOROUS IN TESTING NOT
+    # ONLY NEW PAIRS, BUT ALSO OUR CURRENT ONES FOR CONTINUED COINTEGRATION.        
     
-    # AVERAGE OF THE MOST RECENT DAYS PRICE SPREAD
-    mavg_1 = np.mean(short_prices[goog] - short_prices[fb])
+    # SCHEDULE FUNCTIONS (ONE FUNCTION TRADES EVERY PAIR)
+    schedule_function(check_pairs, date_rules.every_day(), time_rules.market_open())
+
     
-    # IF OUR STDEV IS GREATER THAN 0...
-    if std_21 > 0:
-        
-        # CALCULATE THE Z SCORE BY DIVIDING (TODAYS AVERAGE SPREAD - THE 21 DAY AVERAGE SPREAD) 
-        # BY THE 21 DAY STDEV
-        zscore = (mavg_1 - mavg_21) / std_21
-        
-        # IF THE Z SCORE IS GREATER THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION
-        if zscore > 1.0 and not context.shorting_spread2:
-            order_target_percent(goog,-0.5)
-            order_target_percent(fb,0.5)
-            context.shorting_spread2 = True
-            context.long_on_spread2 = False
-            
-        # IF THE Z SCORE IS LESS THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION    
-        elif zscore < 1.0 and not context.long_on_spread2:
-            order_target_percent(goog,0.5)
-            order_target_percent(fb,-0.5)
-            context.shorting_spread2 = False
-            context.long_on_spread2 = True
-        
-        # IF THE Z SCORE IS LESS THAN 0.25 WE ASSUME THE MEAN HAS REVERTED (ENOUGH), SO WE EXIT OUT PAIRED POSITIONS
-        elif abs(zscore) < 0.25:
-            order_target_percent(goog,0)
-            order_target_percent(fb,0)
-            context.shorting_spread2 = False
-            context.long_on_spread2 = False
-            
-            
-# ENERGY PAIR TRADE (ABGB/FIRST SOLAR)            
-def check_pairs3(context,data):
-    
-    abgb = context.abgb
-    fslr = context.fslr
-    
-    # EACH TIME THE FUNCTION IS CALLED, RETURN THE 21 DAY PRICE HISTORY
-    prices = data.history([abgb,fslr],'price',21,'1d')
-    
-    # RETURN MOST RECENT DAYS PRICES BASED ON ILOC[-1:]
-    short_prices = prices.iloc[-1:] 
-    
-    # AVERAGE OF THE 21 DAY PRICE SPREAD  
-    mavg_21 = np.mean(prices[abgb] - prices[fslr])
-    # STDEV OF THE 21 DAY PRICE SPREAD
-    std_21 = np.std(prices[abgb] - prices[fslr])
-    
-    # AVERAGE OF THE MOST RECENT DAYS PRICE SPREAD
-    mavg_1 = np.mean(short_prices[abgb] - short_prices[fslr])
-    
-    # IF OUR STDEV IS GREATER THAN 0...
-    if std_21 > 0:
-        
-        # CALCULATE THE Z SCORE BY DIVIDING (TODAYS AVERAGE SPREAD - THE 21 DAY AVERAGE SPREAD) 
-        # BY THE 21 DAY STDEV
-        zscore = (mavg_1 - mavg_21) / std_21
-        
-        # IF THE Z SCORE IS GREATER THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION
-        if zscore > 1.0 and not context.shorting_spread3:
-            order_target_percent(abgb,0.5)
-            order_target_percent(fslr,-0.5)
-            context.shorting_spread3 = True
-            context.long_on_spread3 = False
-            
-        # IF THE Z SCORE IS LESS THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION    
-        elif zscore < 1.0 and not context.long_on_spread3:
-            order_target_percent(abgb,-0.5)
-            order_target_percent(fslr,0.5)
-            context.shorting_spread3 = False
-            context.long_on_spread3 = True
-        
-        # IF THE Z SCORE IS LESS THAN 0.25 WE ASSUME THE MEAN HAS REVERTED (ENOUGH), SO WE EXIT OUT PAIRED POSITIONS
-        elif abs(zscore) < 0.25:
-            order_target_percent(abgb,0)
-            order_target_percent(fslr,0)
-            context.shorting_spread3 = False
-            context.long_on_spread3 = False
-            
-            
-            
-# CURRENCY PAIR TRADE (AUSTRALIA/CANADA)            
-def check_pairs4(context,data):
-    
-    aud = context.aud
-    cad = context.cad
-    
-    # EACH TIME THE FUNCTION IS CALLED, RETURN THE 21 DAY PRICE HISTORY
-    prices = data.history([aud,cad],'price',21,'1d')
-    
-    # RETURN MOST RECENT DAYS PRICES BASED ON ILOC[-1:]
-    short_prices = prices.iloc[-1:] 
-    
-    # AVERAGE OF THE 21 DAY PRICE SPREAD  
-    mavg_21 = np.mean(prices[aud] - prices[cad])
-    # STDEV OF THE 21 DAY PRICE SPREAD
-    std_21 = np.std(prices[aud] - prices[cad])
-    
-    # AVERAGE OF THE MOST RECENT DAYS PRICE SPREAD
-    mavg_1 = np.mean(short_prices[aud] - short_prices[cad])
-    
-    # IF OUR STDEV IS GREATER THAN 0...
-    if std_21 > 0:
-        
-        # CALCULATE THE Z SCORE BY DIVIDING (TODAYS AVERAGE SPREAD - THE 21 DAY AVERAGE SPREAD) 
-        # BY THE 21 DAY STDEV
-        zscore = (mavg_1 - mavg_21) / std_21
-        
-        # IF THE Z SCORE IS GREATER THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION
-        if zscore > 1.0 and not context.shorting_spread4:
-            order_target_percent(aud,0.5)
-            order_target_percent(cad,-0.5)
-            context.shorting_spread4 = True
-            context.long_on_spread4 = False
-            
-        # IF THE Z SCORE IS LESS THAN ONE WE EXPECT THE MEAN TO REVERT, SO WE TRADE UNDER THAT ASSUMPTION    
-        elif zscore < 1.0 and not context.long_on_spread4:
-            order_target_percent(aud,-0.5)
-            order_target_percent(cad,0.5)
-            context.shorting_spread4 = False
-            context.long_on_spread4 = True
-        
-        # IF THE Z SCORE IS LESS THAN 0.25 WE ASSUME THE MEAN HAS REVERTED (ENOUGH), SO WE EXIT OUT PAIRED POSITIONS
-        elif abs(zscore) < 0.25:
-            order_target_percent(aud,0)
-            order_target_percent(cad,0)
-            context.shorting_spread4 = False
-            context.long_on_spread4 = False
+# PAIRS TRADE (EVERY PAIR IN THE TABLE)
+def check_pairs(context,data):
+    
+# IN A FRAMEWORK WITH MULTIPLE PAIRS TRADING AT ONCE, WE WOULD ALLOCATE 
+# LESS CAPITAL TO EACH PAIR AND SIMPLY ADD A ROW TO THE PAIRS TABLE. KEEP IN MIND THAT 
+# CERTAIN VARIABLES MAY NEED TO BE TWEAKED ACROSS DIFFERENT PAIRS --NAMELY THE LOOKBACK 
+# PERIOD, TARGET PORTFOLIO WEIGHTS, AND POTENTIALLY THE Z SCORE THRESHOLDS (TRADE SIGNALS).
+
+    pairs = context.pairs
+    
+    # EACH TIME THE FUNCTION IS CALLED, RETURN THE PRICE HISTORY OF ALL LEGS IN ONE CALL
+    # (THE FULL LOOKBACK ON THE FIRST DAY, THEN ONLY THE LAST PUSHED CLOSE, YESTERDAY'S AND TODAY'S PRICE)
+    prices = data.history(pairs.assets, 'price', pairs.history_bars(), '1d')[pairs.assets]
+    
+    # A SPLIT OR DIVIDEND SINCE YESTERDAY RE-ADJUSTED A LEG'S HISTORY: RESEED THE PAIRS OF THAT LEG
+    stale = pairs.stale(prices.values, prices.index)
+    if len(stale):
+        history = data.history(pairs.assets, 'price', pairs.bars + 1, '1d')[pairs.assets]
+        pairs.reseed(stale, history.values, history.index)
+    
+    # Z SCORES OF ALL SPREADS, NEW PAIR STATES AND THE TARGET PERCENT OF EVERY LEG
+    targets, changed = pairs.update(prices.values, prices.index)
+    
+    # ONLY THE LEGS OF PAIRS THAT ENTERED, FLIPPED OR EXITED ARE ORDERED
+    for i in changed:
+        order_target_percent(pairs.assets[i], targets[i])